@@ -1,4 +1,13 @@
+import logging
 import os
+
+# Configuración de logging única para todo el backend; se hace antes de importar los módulos
+# para que también se registren los mensajes emitidos al importarlos.
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
 from granix_backend import create_app
 
 app = create_app()
@@ -1,11 +1,33 @@
 import os
+import orjson
 from flask import Flask
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 from granix_backend.api.routes import transport_bp
 
+class OrjsonProvider(JSONProvider):
+    """
+    Proveedor JSON de Flask basado en orjson: jsonify y request.get_json usan un codificador nativo,
+    bastante más rápido con las respuestas grandes (texto OCR de cada página, ítems y rutas).
+    """
+    # Claves no str (por ejemplo, int) y datetimes sin zona horaria tratados como UTC.
+    DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=self.DUMPS_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Los bytes de orjson van directo a la respuesta, sin decodificar a str y volver a codificar.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.DUMPS_OPTIONS), mimetype="application/json")
+
 def create_app() -> Flask:
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
     CORS(app)
     app.register_blueprint(transport_bp)
     return app
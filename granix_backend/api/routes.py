@@ -1,16 +1,23 @@
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from flask import Blueprint, jsonify, request, current_app
 from werkzeug.utils import secure_filename
 from pdf2image import convert_from_path
 from datetime import datetime
 from firebase_admin import firestore
 
-from granix_backend.services.invoice_service import _process_invoice_image_data
+from granix_backend.db import get_db
+from granix_backend.services.invoice_service import _process_invoice_image_data, _save_invoices, _link_saved_invoices, _discard_invoice_uploads
 from granix_backend.services.delivery_service import process_delivery_report_data
-from granix_backend.utils.shared_utils import geocode_address, _extract_text_from_pdf, extract_text_from_image, temp_file_path
+from granix_backend.utils.shared_utils import geocode_address, _extract_text_from_pdf, extract_text_from_image, uploaded_file_path, PDF_RENDER_THREADS, INVOICE_PDF_RENDER_DPI, INVOICE_PDF_JPEG_QUALITY
 
 transport_bp = Blueprint('transport_bp', __name__)
 
+# Máximo de páginas de una factura PDF procesadas en paralelo (OCR, Cloudinary y Firestore).
+INVOICE_PAGE_WORKERS = 8
+
 @transport_bp.get("/")
 def root():
     return "¡Backend Granix Funcionando!", 200
@@ -44,8 +51,7 @@ def process_invoice():
     results = []
 
     try:
-        with temp_file_path(suffix=filename) as temp_path:
-            file_obj.save(temp_path)
+        with uploaded_file_path(file_obj, suffix=os.path.splitext(filename)[1]) as temp_path:
 
             is_pdf = file_obj.mimetype == 'application/pdf' or filename.lower().endswith(".pdf")
 
@@ -54,11 +60,41 @@ def process_invoice():
                 if not poppler_path:
                     return jsonify(error="La ruta a Poppler no está configurada en las variables de entorno."), 500
                 
-                images = convert_from_path(temp_path, poppler_path=poppler_path)
-                for i, image in enumerate(images):
-                    with temp_file_path(suffix=f"_page_{i+1}.png") as img_temp_path:
-                        image.save(img_temp_path, 'PNG')
-                        results.append(_process_invoice_image_data(img_temp_path))
+                with tempfile.TemporaryDirectory() as pages_dir:
+                    # pdftocairo escribe las páginas directamente como JPEG: no se decodifican ni
+                    # se vuelven a codificar en Python. Luego se procesan en paralelo.
+                    page_paths = convert_from_path(
+                        temp_path,
+                        dpi=INVOICE_PDF_RENDER_DPI,
+                        poppler_path=poppler_path,
+                        output_folder=pages_dir,
+                        paths_only=True,
+                        fmt='jpeg',
+                        jpegopt={'quality': INVOICE_PDF_JPEG_QUALITY},
+                        use_pdftocairo=True,
+                        thread_count=PDF_RENDER_THREADS
+                    )
+
+                    if page_paths:
+                        # Los documentos de las páginas se guardan juntos en un WriteBatch al final, y solo
+                        # las facturas guardadas se vinculan con sus delivery_items. Si falla una página,
+                        # no se guarda ni se vincula ninguna y se borran de Cloudinary las imágenes ya subidas.
+                        pending_writes = []
+                        pending_links = []
+                        try:
+                            with ThreadPoolExecutor(max_workers=min(INVOICE_PAGE_WORKERS, len(page_paths))) as executor:
+                                results.extend(executor.map(
+                                    partial(_process_invoice_image_data, pending_writes=pending_writes, pending_links=pending_links),
+                                    page_paths
+                                ))
+                            failed_invoice_ids = _save_invoices(pending_writes)
+                        except Exception:
+                            _discard_invoice_uploads(pending_writes)
+                            raise
+                        _link_saved_invoices(pending_links, failed_invoice_ids)
+                        if failed_invoice_ids:
+                            _discard_invoice_uploads(pending_writes, failed_invoice_ids)
+                            raise RuntimeError("No se pudieron guardar las facturas en Firestore.")
             elif file_obj.mimetype.startswith('image/') or filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
                 results.append(_process_invoice_image_data(temp_path))
             else:
@@ -88,8 +124,7 @@ def process_delivery_report():
     raw_ocr_text = ""
 
     try:
-        with temp_file_path(suffix=filename) as temp_path:
-            file_obj.save(temp_path)
+        with uploaded_file_path(file_obj, suffix=os.path.splitext(filename)[1]) as temp_path:
 
             is_pdf = file_obj.mimetype == 'application/pdf' or filename.lower().endswith(".pdf")
 
@@ -107,7 +142,7 @@ def process_delivery_report():
         optimized_route = parsed_report_data.get('optimized_route')
         if optimized_route:
             try:
-                db = firestore.client()
+                db = get_db()
                 today_str = datetime.now().strftime("%Y-%m-%d")
                 route_doc_ref = db.collection('daily_routes').document(today_str)
                 
@@ -0,0 +1,20 @@
+import threading
+from firebase_admin import firestore
+
+# Cliente de Firestore compartido por todo el backend (es thread-safe y reutiliza su canal gRPC).
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """
+    Devuelve el cliente de Firestore compartido, creándolo en el primer uso.
+    Se crea de forma diferida porque Firebase Admin se inicializa al importar shared_utils.
+
+    :raises: ValueError si Firebase Admin no está inicializado
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = firestore.client()
+    return _db
@@ -1,36 +1,183 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import polyline
-from math import radians, sin, cos, sqrt, atan2
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from collections import OrderedDict
 
-from granix_backend.utils.shared_utils import geocode_address
+from granix_backend.utils.shared_utils import geocode_address, normalize_coordinates, _normalize_address_key
 
 # Configurar logger
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
-def haversine_distance(coord1, coord2):
+# Dirección fija de la empresa desde donde salen y a donde regresan los repartos.
+DEPOT_ADDRESS = "Mendoza 8195, Rosario, Santa Fe, Argentina"
+
+# Servidor público de OSRM. Para producción, se recomienda un servidor propio.
+OSRM_BASE_URL = "http://router.project-osrm.org"
+
+# Sesión compartida para OSRM: reutiliza las conexiones entre llamadas y reintenta los errores transitorios.
+_osrm_session = requests.Session()
+_osrm_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+)
+_osrm_session.mount("http://", _osrm_adapter)
+_osrm_session.mount("https://", _osrm_adapter)
+
+# Caché de matrices de distancia de OSRM por conjunto de paradas (coordenadas redondeadas a 6 decimales).
+DISTANCE_MATRIX_CACHE_MAXSIZE = 64
+_distance_matrix_cache = OrderedDict()
+_distance_matrix_cache_lock = threading.Lock()
+
+# Hilos para geocodificar en paralelo las paradas que llegan sin coordenadas.
+ROUTE_GEOCODE_WORKERS = 4
+
+# Tiempo máximo de búsqueda de OR-Tools: con la matriz registrada en C++ alcanza para ~100 paradas.
+ROUTE_SOLVER_TIME_LIMIT_SECONDS = 2
+
+# Hasta esta cantidad de ubicaciones (depósito incluido) la ruta se resuelve de forma exacta con Held-Karp.
+EXACT_TSP_MAX_LOCATIONS = 11
+
+def _build_distance_matrix(points: list) -> np.ndarray:
     """
-    Calcula la distancia de gran círculo entre dos puntos en la tierra (en metros).
+    Construye la matriz de distancias haversine (en metros, enteros) entre todos los puntos (lat, lon)
+    en una sola pasada vectorizada con NumPy, en lugar de un doble bucle en Python.
     """
     R = 6371000  # Radio de la Tierra en metros
-    lat1, lon1 = radians(coord1['latitude']), radians(coord1['longitude'])
-    lat2, lon2 = radians(coord2['latitude']), radians(coord2['longitude'])
+    # Un solo arreglo contiguo (n, 2) en radianes en lugar de dos listas intermedias.
+    coords = np.radians(np.asarray(points, dtype=np.float64))
+    lats = coords[:, 0]
+    lons = coords[:, 1]
+
+    cos_lats = np.cos(lats)
+    a = np.sin((lats[:, None] - lats[None, :]) / 2)**2
+    a += np.outer(cos_lats, cos_lats) * np.sin((lons[:, None] - lons[None, :]) / 2)**2
+    # arcsin(sqrt(a)) equivale a atan2(sqrt(a), sqrt(1 - a)); se acota a 1 por errores de redondeo.
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    return (R * c).astype(np.int64) # OR-Tools prefiere distancias enteras
+
+def _fetch_osrm_distance_matrix(points) -> np.ndarray | None:
+    """
+    Obtiene la matriz de distancias por calle (en metros) entre todos los puntos (lat, lon)
+    con una sola llamada al servicio /table de OSRM. Devuelve None si OSRM no responde correctamente.
+    """
+    coords_str = ";".join(map("{0[1]},{0[0]}".format, points))
+    url = f"{OSRM_BASE_URL}/table/v1/driving/{coords_str}?annotations=distance"
+
+    try:
+        response = _osrm_session.get(url, timeout=15)
+        response.raise_for_status()
+        data = response.json()
+    except Exception as e:
+        logger.warning(f"Error al obtener la matriz de distancias de OSRM: {e}")
+        return None
+
+    if data.get('code') != 'Ok' or not data.get('distances'):
+        logger.warning(f"OSRM no pudo calcular la matriz de distancias. Respuesta: {data.get('message')}")
+        return None
+
+    # OSRM devuelve null para pares sin ruta: en ese caso se descarta la matriz completa.
+    distances = np.array(data['distances'], dtype=np.float64)
+    if distances.shape != (len(points), len(points)) or np.isnan(distances).any():
+        logger.warning("La matriz de distancias de OSRM está incompleta.")
+        return None
+
+    return np.rint(distances).astype(np.int64)
+
+def _get_distance_matrix(locations: list) -> np.ndarray:
+    """
+    Devuelve la matriz de distancias para las ubicaciones dadas, reutilizando la matriz calculada
+    para el mismo conjunto de paradas en invocaciones anteriores (sin importar su orden).
+    Se usan distancias por calle de OSRM y, si no están disponibles, distancias haversine
+    (que no se guardan en la caché).
+    """
+    points = [
+        (round(loc['coordinates']['latitude'], 6), round(loc['coordinates']['longitude'], 6))
+        for loc in locations
+    ]
+    canonical_points = tuple(sorted(set(points)))
+
+    with _distance_matrix_cache_lock:
+        matrix = _distance_matrix_cache.get(canonical_points)
+        if matrix is not None:
+            _distance_matrix_cache.move_to_end(canonical_points)
 
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
+    if matrix is None:
+        matrix = _fetch_osrm_distance_matrix(canonical_points)
+        if matrix is None:
+            # La matriz haversine no se guarda en la caché: si OSRM falló de forma transitoria,
+            # la próxima optimización de estas paradas vuelve a intentar con OSRM.
+            logger.info("Usando distancias haversine para la matriz de distancias.")
+            matrix = _build_distance_matrix(canonical_points)
+        else:
+            with _distance_matrix_cache_lock:
+                _distance_matrix_cache[canonical_points] = matrix
+                if len(_distance_matrix_cache) > DISTANCE_MATRIX_CACHE_MAXSIZE:
+                    _distance_matrix_cache.popitem(last=False)
+    else:
+        logger.info("Matriz de distancias reutilizada desde la caché.")
+
+    # Reordenar la matriz canónica al orden de las ubicaciones recibidas.
+    point_index = {point: i for i, point in enumerate(canonical_points)}
+    order = [point_index[point] for point in points]
+    return matrix[np.ix_(order, order)]
+
+def _solve_tsp_exact(distance_matrix: np.ndarray) -> tuple[list, int]:
+    """
+    Resuelve el TSP de forma exacta con programación dinámica (Held-Karp), saliendo y volviendo al nodo 0.
+    Cada subconjunto de paradas se procesa vectorizado con NumPy: O(2^n · n^2) operaciones.
+
+    :param distance_matrix: Matriz (n, n) de distancias enteras; el nodo 0 es el depósito
+    :return: Tupla (orden de visita de los nodos 1..n-1, distancia total)
+    """
+    num_stops = distance_matrix.shape[0] - 1
+    if num_stops <= 0:
+        return [], 0
+
+    stop_distances = distance_matrix[1:, 1:]
+    full_mask = (1 << num_stops) - 1
+    bits = 1 << np.arange(num_stops)
+    stop_indexes = np.arange(num_stops)
+
+    # cost[mask, j]: distancia mínima desde el depósito visitando las paradas de mask y terminando en j.
+    cost = np.full((full_mask + 1, num_stops), np.iinfo(np.int64).max // 4, dtype=np.int64)
+    parent = np.full((full_mask + 1, num_stops), -1, dtype=np.int64)
+    cost[bits, stop_indexes] = distance_matrix[0, 1:]
+
+    for mask in range(1, full_mask):
+        in_mask = (mask & bits) != 0
+        visited = stop_indexes[in_mask]
+        pending = stop_indexes[~in_mask]
+
+        # Mejor parada final j del subconjunto para extender el recorrido hacia cada parada pendiente k.
+        candidates = cost[mask, visited][:, None] + stop_distances[np.ix_(visited, pending)]
+        best = candidates.argmin(axis=0)
+        best_cost = candidates[best, np.arange(pending.size)]
+
+        next_masks = mask | bits[pending]
+        improved = best_cost < cost[next_masks, pending]
+        cost[next_masks[improved], pending[improved]] = best_cost[improved]
+        parent[next_masks[improved], pending[improved]] = visited[best[improved]]
 
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    total_costs = cost[full_mask] + distance_matrix[1:, 0]
+    last_stop = int(total_costs.argmin())
 
-    distance = R * c
-    return int(distance) # OR-Tools prefiere distancias enteras
+    # Reconstruir el recorrido desde la última parada hacia atrás.
+    order = []
+    mask = full_mask
+    stop = last_stop
+    while stop != -1:
+        order.append(stop + 1)
+        previous_stop = int(parent[mask, stop])
+        mask ^= 1 << stop
+        stop = previous_stop
+    order.reverse()
+    return order, int(total_costs[last_stop])
 
 def optimize_route(addresses: list):
     """
@@ -41,12 +188,11 @@ def optimize_route(addresses: list):
     if not addresses:
         return []
 
-    # 1. Definir el depósito y obtener sus coordenadas.
-    # Esta es la dirección fija de la empresa desde donde salen y a donde regresan los repartos.
-    depot_address = "Mendoza 8195, Rosario, Santa Fe, Argentina"
-    depot_coords = geocode_address(depot_address)
+    # 1. Obtener las coordenadas del depósito (se resuelven desde la caché de geocodificación).
+    depot_address = DEPOT_ADDRESS
+    depot_coords = normalize_coordinates(geocode_address(depot_address))
 
-    if not depot_coords or depot_coords.get('latitude') is None:
+    if depot_coords is None:
         logger.error(f"No se pudieron obtener las coordenadas para el depósito: {depot_address}. No se puede optimizar la ruta.")
         return addresses
 
@@ -57,15 +203,28 @@ def optimize_route(addresses: list):
     # Su índice (0) se usará para definir el inicio y fin de la ruta.
     all_locations = [depot_location] + addresses
     location_coords = []
+    coordinates = [normalize_coordinates(loc.get('coordinates')) for loc in all_locations]
 
-    for i, loc in enumerate(all_locations):
-        coords = loc.get('coordinates')
-        # Si una dirección de entrega no tiene coordenadas, intenta geocodificarla.
-        if (not coords or coords.get('latitude') is None) and not loc.get('is_depot'):
-            logger.info(f"Coordenadas no encontradas para '{loc['address']}', geocodificando...")
-            coords = geocode_address(loc['address'])
+    # Si una dirección de entrega no tiene coordenadas, intenta geocodificarla. Las consultas se
+    # solapan en paralelo; la frecuencia de las llamadas a Nominatim se limita en shared_utils.
+    missing_indexes = [i for i, coords in enumerate(coordinates) if coords is None and not all_locations[i].get('is_depot')]
+    if missing_indexes:
+        for i in missing_indexes:
+            logger.debug("Coordenadas no encontradas para '%s', geocodificando...", all_locations[i]['address'])
+        # Una sola consulta por dirección distinta (normalizada), aunque se repita en varias paradas.
+        indexes_by_address = {}
+        for i in missing_indexes:
+            address = all_locations[i]['address']
+            indexes_by_address.setdefault(_normalize_address_key(address or ''), (address, []))[1].append(i)
+        unique_addresses = [address for address, _ in indexes_by_address.values()]
+        with ThreadPoolExecutor(max_workers=min(ROUTE_GEOCODE_WORKERS, len(unique_addresses))) as executor:
+            geocoded = executor.map(geocode_address, unique_addresses)
+            for (_, indexes), coords in zip(indexes_by_address.values(), geocoded):
+                for i in indexes:
+                    coordinates[i] = normalize_coordinates(coords)
 
-        if coords and coords.get('latitude') is not None:
+    for loc, coords in zip(all_locations, coordinates):
+        if coords is not None:
             loc['coordinates'] = coords
             location_coords.append(loc)
         else:
@@ -75,43 +234,58 @@ def optimize_route(addresses: list):
         logger.warning("No hay suficientes ubicaciones con coordenadas para optimizar. Se devuelve el orden original.")
         return addresses
 
-    # 3. Construir la matriz de distancias entre todas las ubicaciones.
-    num_locations = len(location_coords)
-    distance_matrix = [[0] * num_locations for _ in range(num_locations)]
-    for i in range(num_locations):
-        for j in range(num_locations):
-            if i != j:
-                distance_matrix[i][j] = haversine_distance(
-                    location_coords[i]['coordinates'],
-                    location_coords[j]['coordinates']
-                )
-
-    # 4. Configurar y resolver el problema de enrutamiento con OR-Tools.
+    # 3. Agrupar las entregas con las mismas coordenadas (mismo edificio, varias facturas):
+    # el solver trabaja con un nodo por punto y luego se expande cada grupo en la ruta.
+    stop_groups = {}
+    for loc in location_coords[1:]:
+        point = (round(loc['coordinates']['latitude'], 6), round(loc['coordinates']['longitude'], 6))
+        stop_groups.setdefault(point, []).append(loc)
+    node_stops = [[depot_location]] + list(stop_groups.values())
+    node_locations = [stops[0] for stops in node_stops]
+
+    # 4. Construir la matriz de distancias entre los puntos distintos.
+    num_locations = len(node_locations)
+    distance_array = _get_distance_matrix(node_locations)
+
+    # Con pocas paradas, la solución exacta por programación dinámica tarda milisegundos
+    # y evita el tiempo fijo de búsqueda de OR-Tools.
+    if num_locations <= EXACT_TSP_MAX_LOCATIONS:
+        node_order, total_distance = _solve_tsp_exact(distance_array)
+        logger.info(f"Solución exacta encontrada con una distancia total de: {total_distance} metros.")
+        return [stop for node_index in node_order for stop in node_stops[node_index]]
+
+    distance_matrix = distance_array.tolist()
+
+    # OR-Tools solo hace falta para rutas grandes: se importa aquí para no cargarlo al iniciar la app.
+    from ortools.constraint_solver import routing_enums_pb2
+    from ortools.constraint_solver import pywrapcp
+
+    # 5. Configurar y resolver el problema de enrutamiento con OR-Tools.
     # Se crea un gestor de índices de enrutamiento.
     # - num_locations: Total de paradas.
     # - 1: Número de vehículos (en este caso, una sola ruta).
     # - [0]: Nodo de inicio (índice 0, que corresponde al depósito).
     # - [0]: Nodo de fin (índice 0, forzando el regreso al depósito).
     manager = pywrapcp.RoutingIndexManager(num_locations, 1, [0], [0])
-    routing = pywrapcp.RoutingModel(manager)
-
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return distance_matrix[from_node][to_node]
+    model_parameters = pywrapcp.DefaultRoutingModelParameters()
+    model_parameters.reduce_vehicle_cost_model = True
+    model_parameters.max_callback_cache_size = num_locations * num_locations
+    routing = pywrapcp.RoutingModel(manager, model_parameters)
 
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # La matriz se registra una sola vez y queda en C++: el solver no vuelve a llamar a Python por cada arco.
+    transit_callback_index = routing.RegisterTransitMatrix(distance_matrix)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION)
     search_parameters.local_search_metaheuristic = (routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.FromSeconds(5)
+    # El tiempo de búsqueda crece con la cantidad de paradas (1 s cada 10), hasta el máximo configurado.
+    search_parameters.time_limit.FromSeconds(max(1, min(ROUTE_SOLVER_TIME_LIMIT_SECONDS, num_locations // 10)))
 
     logger.info("Resolviendo la ruta óptima con OR-Tools...")
     solution = routing.SolveWithParameters(search_parameters)
 
-    # 5. Extraer y devolver la ruta optimizada.
+    # 6. Extraer y devolver la ruta optimizada.
     if solution:
         logger.info(f"Solución encontrada con una distancia total de: {solution.ObjectiveValue()} metros.")
         ordered_route = []
@@ -120,7 +294,7 @@ def optimize_route(addresses: list):
         index = solution.Value(routing.NextVar(index))
         while not routing.IsEnd(index):
             node_index = manager.IndexToNode(index)
-            ordered_route.append(location_coords[node_index])
+            ordered_route.extend(node_stops[node_index])
             index = solution.Value(routing.NextVar(index))
         
         # La ruta devuelta contiene solo las direcciones de entrega en el orden óptimo.
@@ -129,6 +303,26 @@ def optimize_route(addresses: list):
         logger.error("No se encontró una solución para la optimización de la ruta.")
         return addresses
 
+def _decode_polyline(encoded_polyline: str) -> np.ndarray:
+    """
+    Decodifica una polilínea codificada de OSRM (precisión 5) en un arreglo (n, 2) de [lat, lon].
+    Procesa todos los caracteres a la vez con NumPy en lugar de recorrerlos uno a uno en Python.
+    """
+    chunks = np.frombuffer(encoded_polyline.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if chunks.size == 0:
+        return np.empty((0, 2), dtype=np.float64)
+
+    # Cada valor ocupa varios caracteres de 5 bits; el último de cada valor no tiene el bit 0x20.
+    is_last = (chunks & 0x20) == 0
+    value_ids = np.concatenate(([0], np.cumsum(is_last[:-1])))
+    value_starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    shifts = 5 * (np.arange(chunks.size) - value_starts[value_ids])
+    values = np.add.reduceat((chunks & 0x1f) << shifts, value_starts)
+
+    # Decodificación zigzag de las diferencias y suma acumulada para obtener las coordenadas.
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 1e5
+
 def get_street_level_route(stops: list) -> list:
     """
     Obtiene una polilínea de ruta a nivel de calle desde OSRM para una lista de paradas.
@@ -141,18 +335,16 @@ def get_street_level_route(stops: list) -> list:
         return []
 
     # Formatear las coordenadas para la URL de la API de OSRM (lon,lat;lon,lat;...)
-    coords_str = ";".join(
-        f"{stop['coordinates']['longitude']},{stop['coordinates']['latitude']}" 
-        for stop in stops if stop.get('coordinates')
-    )
+    # El formato se resuelve con un único str.format por parada, sin accesos anidados en Python.
+    stop_coordinates = [stop['coordinates'] for stop in stops if stop.get('coordinates')]
+    coords_str = ";".join(map("{0[longitude]},{0[latitude]}".format, stop_coordinates))
 
-    # URL del servidor público de OSRM. Para producción, se recomienda un servidor propio.
     # Parámetros: overview=full (geometría detallada), geometries=polyline (formato codificado)
-    url = f"http://router.project-osrm.org/route/v1/driving/{coords_str}?overview=full&geometries=polyline"
+    url = f"{OSRM_BASE_URL}/route/v1/driving/{coords_str}?overview=full&geometries=polyline"
 
     try:
         logger.info("Consultando a OSRM para obtener la ruta a nivel de calle...")
-        response = requests.get(url, timeout=15)
+        response = _osrm_session.get(url, timeout=15)
         response.raise_for_status()  # Lanza un error para respuestas 4xx/5xx
         
         data = response.json()
@@ -162,10 +354,10 @@ def get_street_level_route(stops: list) -> list:
             encoded_polyline = data['routes'][0]['geometry']
             
             # Decodificar la polilínea para obtener una lista de coordenadas [lat, lon]
-            decoded_coords = polyline.decode(encoded_polyline)
+            decoded_coords = _decode_polyline(encoded_polyline)
             
             logger.info(f"Ruta a nivel de calle obtenida con {len(decoded_coords)} puntos.")
-            return decoded_coords
+            return decoded_coords.tolist()
         else:
             logger.error(f"OSRM no pudo encontrar una ruta. Respuesta: {data.get('message')}")
             return []
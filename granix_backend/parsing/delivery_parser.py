@@ -1,12 +1,71 @@
 import re
+import sys
 import logging
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+def _normalize_address_separator(match) -> str:
+    """Reemplaza un separador de la dirección: ', ' por cada coma, un espacio si contenía "N°"."""
+    separator = match.group(0)
+    comma_count = separator.count(',')
+    if comma_count:
+        return ', ' * comma_count
+    if separator.strip():
+        return ' '
+    return separator
+
+def _remove_ignoring_case(text: str, literal: str) -> str:
+    """Elimina todas las apariciones de un literal sin distinguir mayúsculas, sin compilar una regex."""
+    text_lower = text.lower()
+    literal_lower = literal.lower()
+    parts = []
+    start = 0
+    position = text_lower.find(literal_lower)
+    while position != -1:
+        parts.append(text[start:position])
+        start = position + len(literal_lower)
+        position = text_lower.find(literal_lower, start)
+    parts.append(text[start:])
+    return "".join(parts)
+
+@dataclass(slots=True)
+class DeliveryItem:
+    """
+    Ítem de un informe de reparto. Los campos de cliente, coordenadas y estado
+    se completan durante el procesamiento en delivery_service.
+    """
+    type: str
+    invoice_number: str
+    commercial_entity: str
+    delivery_address: str
+    packages: int
+    delivery_instructions: str
+    coordinates: dict | None = None
+    customer_id: str | None = None
+    status: str | None = None
+    error_notes: str | None = None
+
+    def to_dict(self) -> dict:
+        """
+        Devuelve el ítem con las claves del diccionario que se usaba antes de DeliveryItem: los ítems con
+        dirección incluyen 'address' y los campos que no se completaron se omiten en lugar de ir en null.
+        """
+        item_dict = {
+            'type': self.type,
+            'invoice_number': self.invoice_number,
+            'commercial_entity': self.commercial_entity,
+            'delivery_address': self.delivery_address,
+            'packages': self.packages,
+            'delivery_instructions': self.delivery_instructions
+        }
+        if self.delivery_address and self.delivery_address != 'No encontrado':
+            item_dict['address'] = self.delivery_address
+        for field_name in ('customer_id', 'coordinates', 'status', 'error_notes'):
+            value = getattr(self, field_name)
+            if value is not None:
+                item_dict[field_name] = value
+        return item_dict
 
 class DeliveryReportParser:
     def __init__(self):
@@ -16,26 +75,63 @@ class DeliveryReportParser:
         self.summary_pattern = re.compile(
             r'(?:Cantidad de Facturas:\s*(\d+)\s+)?Cantidad de Remitos:\s*(\d+)\s+Bultos:\s*(\d+)'
         )
-        self.packages_match_pattern = re.compile(r'(\d+)\s*$')
+        self.continuation_prefix_pattern = re.compile(r'^(?:Suc|ESQ|S\.R\.L)\b\.?\s*\d*\s*', re.IGNORECASE)
         self.invoice_number_normalize_pattern = re.compile(r'(P029[89]-\d{6,11})')
-        self.address_pattern = re.compile(
-            r'(?:.*?)((?:Pasaje|Pje\.|Alvear|San Juan|Zeballos|Velez Sarsfield|Cordiviola|Drago|Del Valle|Andrade|Sanchez De Bustamante|Corrientes|Buenos Aires|Entre Rios|Marco Polo|Ibarlucea|Nansen|Reconquista|Av. Alberdi|Balcarce|3 De Febrero|Mendoza|Rodriguez|Santiago|San Luis|Ayacucho|San Martin|Laprida|Arijon|Regimiento|Artigas|Thedy|French|Juan Jose Paso|Genova|Jose Ingenieros)(?:[\s\w,.]*?)(?:N[°º.]?\s*)?\d+)(?:,\s*[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñA-ZÁÉÍÓÚÜÑ\s]*)*,\s*Rosario',
+        street_names = [
+            'Pasaje', 'Pje.', 'Alvear', 'San Juan', 'Zeballos', 'Velez Sarsfield', 'Cordiviola', 'Drago', 'Del Valle',
+            'Andrade', 'Sanchez De Bustamante', 'Corrientes', 'Buenos Aires', 'Entre Rios', 'Marco Polo', 'Ibarlucea',
+            'Nansen', 'Reconquista', 'Balcarce', '3 De Febrero', 'Mendoza', 'Rodriguez', 'Santiago',
+            'San Luis', 'Ayacucho', 'San Martin', 'Laprida', 'Arijon', 'Regimiento', 'Artigas', 'Thedy', 'French',
+            'Juan Jose Paso', 'Genova', 'Jose Ingenieros',
+        ]
+        # Nombres de calle en minúsculas, de mayor a menor longitud para preferir la coincidencia más específica.
+        self._street_names_lower = tuple(sorted((name.lower() for name in street_names), key=len, reverse=True))
+        # "Av. Alberdi" no es un literal: el OCR suele leer el punto como coma o perderlo ("Av, Alberdi", "Av Alberdi").
+        self.avenue_alberdi_pattern = re.compile(r'av(?:.\s|[.,]?\s*)alberdi', re.IGNORECASE)
+        # Resto de la dirección a partir del final del nombre de la calle: altura y localidad.
+        self.address_tail_pattern = re.compile(
+            r'([\s\w,.]*?(?:N[°º.]?\s*)?\d+)(?:,\s*[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñA-ZÁÉÍÓÚÜÑ\s]*)*,\s*Rosario',
             re.IGNORECASE
         )
+        # Secuencias de espacios, comas y prefijos "N°" entre las partes de la dirección.
+        self.address_separator_pattern = re.compile(r'(?:\s+N[°º.]?|\s|,)+', re.IGNORECASE)
         self.delivery_instruction_pattern = re.compile(r'Entrega:\s*(.*)', re.IGNORECASE)
+        # Limpieza del nombre comercial: sufijos de sucursal/esquina, caracteres no válidos y espacios.
+        self.commercial_suffix_pattern = re.compile(r'\b(?:ESQ|SUC|S\.R\.L|AV)\b\.?\s*\d*', re.IGNORECASE)
+        self.commercial_invalid_chars_pattern = re.compile(r'[^A-ZÁÉÍÓÚÜÑ\s.,-]')
+        self.whitespace_pattern = re.compile(r'\s+')
 
     def parse_delivery_report_text(self, raw_ocr_text: str) -> dict:
-        delivery_items = []
+        delivery_items: list[DeliveryItem] = []
+        # Partes de las instrucciones de cada ítem (en paralelo a delivery_items); se unen al final.
+        instruction_parts: list[list[str]] = []
         total_invoices = 0
         total_remitos = 0
         total_packages_summary = 0
 
+        # Atajo: sin números de comprobante (P029...) ni línea de resumen no hay nada que parsear.
+        if 'P029' not in raw_ocr_text and 'Bultos:' not in raw_ocr_text:
+            return {
+                "delivery_items": delivery_items,
+                "total_invoices": total_invoices,
+                "total_remitos": total_remitos,
+                "total_packages_summary": total_packages_summary
+            }
+
         lines = raw_ocr_text.split('\n')
         last_line_had_instruction = False
 
+        # Métodos ligados a variables locales: evita la búsqueda de atributos en cada línea.
+        item_search = self.item_line_pattern.search
+        summary_search = self.summary_pattern.search
+        continuation_sub = self.continuation_prefix_pattern.sub
+
         for line in lines:
-            item_match = self.item_line_pattern.search(line)
-            
+            # Las líneas de ítem siempre contienen "P029" y la de resumen "Bultos:": la comprobación de
+            # subcadena descarta en C la mayoría de las líneas antes de pasar por el motor de regex.
+            item_match = item_search(line) if 'P029' in line else None
+            summary_match = summary_search(line) if 'Bultos:' in line else None
+
             if item_match:
                 item_type = item_match.group(1)
                 raw_invoice_number_part = item_match.group(2)
@@ -45,33 +141,35 @@ class DeliveryReportParser:
                 invoice_number = self._normalize_invoice_number(raw_invoice_number_part)
                 commercial_entity, delivery_address, delivery_instruction = self._extract_commercial_entity_and_address(rest_of_line_after_packages)
 
-                delivery_items.append({
-                    "type": item_type,
-                    "invoice_number": invoice_number,
-                    "commercial_entity": commercial_entity if commercial_entity else "No encontrado",
-                    "delivery_address": delivery_address,
-                    "packages": packages,
-                    "delivery_instructions": delivery_instruction if delivery_instruction else "No encontrado"
-                })
+                # Los tipos y nombres comerciales se repiten mucho entre líneas: se internan para compartir memoria.
+                delivery_items.append(DeliveryItem(
+                    type=sys.intern(item_type),
+                    invoice_number=invoice_number,
+                    commercial_entity=sys.intern(commercial_entity) if commercial_entity else "No encontrado",
+                    delivery_address=delivery_address,
+                    packages=packages,
+                    delivery_instructions="No encontrado"
+                ))
+                instruction_parts.append([delivery_instruction] if delivery_instruction else [])
                 
-                if delivery_instruction:
-                    last_line_had_instruction = True
-                else:
-                    last_line_had_instruction = False
+                last_line_had_instruction = bool(delivery_instruction)
 
-            elif last_line_had_instruction and not self.summary_pattern.search(line) and line.strip():
-                clean_line = re.sub(r'^(?:Suc|ESQ|S\.R\.L)\b\.?\s*\d*\s*', '', line.strip(), flags=re.IGNORECASE).strip()
+            elif last_line_had_instruction and not summary_match and line.strip():
+                clean_line = continuation_sub('', line.strip()).strip()
                 if clean_line:
-                    delivery_items[-1]["delivery_instructions"] += " " + clean_line
+                    instruction_parts[-1].append(clean_line)
             
             else:
                 last_line_had_instruction = False
 
-            summary_match = self.summary_pattern.search(line)
             if summary_match:
                 total_invoices, total_remitos, total_packages_summary = self._parse_summary_line(summary_match)
                 last_line_had_instruction = False
 
+        # Las instrucciones de varias líneas se acumulan en partes y se unen una sola vez.
+        for item, parts in zip(delivery_items, instruction_parts):
+            item.delivery_instructions = " ".join(parts) or "No encontrado"
+
         return {
             "delivery_items": delivery_items,
             "total_invoices": total_invoices,
@@ -80,16 +178,18 @@ class DeliveryReportParser:
         }
 
     def _extract_packages(self, text: str) -> tuple[int, str]:
-        packages = 0
-        rest_of_line_after_packages = text
-        packages_match = self.packages_match_pattern.search(text)
-        if packages_match:
-            packages = int(packages_match.group(1))
-            rest_of_line_after_packages = re.sub(self.packages_match_pattern, '', text).strip()
-        return packages, rest_of_line_after_packages
+        # Escaneo manual de los dígitos finales (equivalente a r'(\d+)\s*$' sin pasar por el motor de regex).
+        stripped = text.rstrip()
+        end = len(stripped)
+        start = end
+        while start > 0 and stripped[start - 1].isdecimal():
+            start -= 1
+        if start == end:
+            return 0, text
+        return int(stripped[start:end]), stripped[:start].strip()
 
     def _normalize_invoice_number(self, raw_number_part: str) -> str:
-        invoice_number = re.sub(r'\s+', '', raw_number_part).strip()
+        invoice_number = self.whitespace_pattern.sub('', raw_number_part).strip()
         invoice_number_match = self.invoice_number_normalize_pattern.search(invoice_number)
         if invoice_number_match:
             invoice_number = invoice_number_match.group(1)
@@ -108,45 +208,62 @@ class DeliveryReportParser:
             delivery_instruction = instruction_match.group(1).strip()
             text = text[:instruction_match.start()].strip()
 
-        address_match = self.address_pattern.search(text)
+        address_span = self._find_address_span(text)
 
-        if address_match:
-            delivery_address = address_match.group(1).strip()
-            commercial_entity = text[:address_match.start(1)].strip()
+        if address_span:
+            address_start, address_end = address_span
+            delivery_address = text[address_start:address_end].strip()
+            commercial_entity = text[:address_start].strip()
 
             # Clean commercial entity
-            commercial_entity = re.sub(self.invoice_number_normalize_pattern, '', commercial_entity).strip()
-            commercial_entity = re.sub(r'\b(?:ESQ|SUC|S\.R\.L|AV)\b\.?\s*\d*', '', commercial_entity, flags=re.IGNORECASE).strip()
+            commercial_entity = self.invoice_number_normalize_pattern.sub('', commercial_entity).strip()
+            commercial_entity = self.commercial_suffix_pattern.sub('', commercial_entity).strip()
             commercial_entity = commercial_entity.upper()
-            commercial_entity = re.sub(r'[^A-ZÁÉÍÓÚÜÑ\s.,-]', '', commercial_entity).strip()
-            commercial_entity = re.sub(r'\s+', ' ', commercial_entity).strip()
+            commercial_entity = self.commercial_invalid_chars_pattern.sub('', commercial_entity).strip()
+            commercial_entity = self.whitespace_pattern.sub(' ', commercial_entity).strip()
 
             # Clean delivery address
-            delivery_address = re.sub(r'\s+N[°º.]?\s*', ' ', delivery_address, flags=re.IGNORECASE).strip()
-
             commercial_entity_to_remove = commercial_entity.title() if commercial_entity else ""
             if commercial_entity_to_remove and commercial_entity_to_remove in delivery_address:
-                delivery_address = re.sub(re.escape(commercial_entity_to_remove), '', delivery_address, flags=re.IGNORECASE).strip()
-
-            delivery_address_parts = []
-            for part in delivery_address.split(','):
-                part = part.strip()
-                if part.lower() == "rosario":
-                    delivery_address_parts.append("Rosario")
-                else:
-                    delivery_address_parts.append(part.title())
-            delivery_address = ", ".join(delivery_address_parts)
-            delivery_address = re.sub(r'\bde\b', 'De', delivery_address)
+                delivery_address = _remove_ignoring_case(delivery_address, commercial_entity_to_remove).strip()
+
+            # Una sola pasada: quita el prefijo "N°" de la altura y normaliza los separadores a ", ".
+            # title() ya deja "Rosario" y "De" capitalizados.
+            delivery_address = self.address_separator_pattern.sub(_normalize_address_separator, delivery_address).title()
 
         else:
             # Clean commercial entity even if no address is found
             commercial_entity = text.upper()
-            commercial_entity = re.sub(r'\b(?:ESQ|SUC|S\.R\.L|AV)\b\.?\s*\d*', '', commercial_entity, flags=re.IGNORECASE).strip()
-            commercial_entity = re.sub(r'[^A-ZÁÉÍÓÚÜÑ\s.,-]', '', commercial_entity).strip()
-            commercial_entity = re.sub(r'\s+', ' ', commercial_entity).strip()
+            commercial_entity = self.commercial_suffix_pattern.sub('', commercial_entity).strip()
+            commercial_entity = self.commercial_invalid_chars_pattern.sub('', commercial_entity).strip()
+            commercial_entity = self.whitespace_pattern.sub(' ', commercial_entity).strip()
 
         return commercial_entity, delivery_address, delivery_instruction
 
+    def _find_address_span(self, text: str):
+        """
+        Busca la dirección de entrega ubicando los nombres de calle conocidos con str.find,
+        y usa la expresión regular solo para validar la altura y la localidad que siguen.
+        Devuelve (inicio, fin) de la dirección o None si no se encuentra.
+        """
+        text_lower = text.lower()
+        candidates = []
+        for name in self._street_names_lower:
+            position = text_lower.find(name)
+            while position != -1:
+                candidates.append((position, -len(name)))
+                position = text_lower.find(name, position + 1)
+        if 'alberdi' in text_lower:
+            for street_match in self.avenue_alberdi_pattern.finditer(text):
+                candidates.append((street_match.start(), street_match.start() - street_match.end()))
+
+        # Se prueba desde la aparición más temprana, como lo hacía la búsqueda con regex.
+        for position, negative_length in sorted(candidates):
+            tail_match = self.address_tail_pattern.match(text, position - negative_length)
+            if tail_match:
+                return position, tail_match.end(1)
+        return None
+
     def _parse_summary_line(self, summary_match) -> tuple[int, int, int]:
         total_invoices = 0
         total_remitos = 0
@@ -1,18 +1,72 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from uuid import uuid4
 import firebase_admin
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 
-from granix_backend.utils.shared_utils import geocode_address
+from granix_backend.db import get_db
+from granix_backend.utils.shared_utils import geocode_address, FIRESTORE_IN_QUERY_LIMIT, FIRESTORE_BATCH_LIMIT
 
 # Configurar logger
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+# Hilos para las consultas por lotes y la geocodificación de clientes nuevos (liberan el GIL).
+CUSTOMER_BULK_WORKERS = 16
+
+# upsert_customer y bulk_upsert leen y después escriben: dos llamadas en paralelo para la misma dirección nueva
+# (por ejemplo, dos páginas de una factura, o una factura y un informe de reparto) crearían el cliente dos veces.
+# Las creaciones de una misma dirección se serializan con un candado tomado de un conjunto fijo, repartido por
+# hash de la dirección.
+CUSTOMER_ADDRESS_LOCKS = 64
+_address_locks = [threading.Lock() for _ in range(CUSTOMER_ADDRESS_LOCKS)]
+
+def _address_lock(address: str) -> threading.Lock:
+    """Devuelve el candado que serializa los upserts de la dirección indicada."""
+    return _address_locks[hash(address) % CUSTOMER_ADDRESS_LOCKS]
+
+@contextmanager
+def _address_locks_for(addresses: list):
+    """Toma los candados de varias direcciones, siempre en el mismo orden para evitar interbloqueos."""
+    with ExitStack() as stack:
+        for index in sorted({hash(address) % CUSTOMER_ADDRESS_LOCKS for address in addresses}):
+            stack.enter_context(_address_locks[index])
+        yield
+
+def _build_update_data(existing_customer: dict, data: dict, source_type: str) -> dict:
+    """Devuelve los campos del cliente que cambian con los datos recibidos (vacío si no hay cambios)."""
+    update_data = {}
+
+    if source_type == 'delivery_report':
+        new_commercial_name = data.get('commercial_entity')
+        if new_commercial_name and new_commercial_name != existing_customer.get('commercial_name'):
+            update_data['commercial_name'] = new_commercial_name
+
+        new_instructions = data.get('delivery_instructions')
+        if new_instructions and new_instructions != 'No encontrado' and new_instructions != existing_customer.get('delivery_instructions'):
+            update_data['delivery_instructions'] = new_instructions
+
+    elif source_type == 'invoice':
+        new_client_name = data.get('client_name')
+        if new_client_name and new_client_name != existing_customer.get('client_name'):
+            update_data['client_name'] = new_client_name
+
+    return update_data
+
+def _build_new_customer(customer_id: str, address: str, coordinates: dict, data: dict, source_type: str) -> dict:
+    """Arma el documento de un cliente nuevo."""
+    return {
+        'id': customer_id,
+        'address': address,
+        'coordinates': coordinates,
+        'client_name': data.get('client_name') if source_type == 'invoice' else None,
+        'commercial_name': data.get('commercial_entity') if source_type == 'delivery_report' else None,
+        'delivery_instructions': data.get('delivery_instructions') if source_type == 'delivery_report' else None,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'last_updated_at': firestore.SERVER_TIMESTAMP
+    }
 
 class CustomerService:
     def __init__(self):
@@ -20,7 +74,7 @@ class CustomerService:
             firebase_admin.get_app()
         except ValueError:
             raise ConnectionError("Firebase Admin no está inicializado.")
-        self.db = firestore.client()
+        self.db = get_db()
         self.collection_ref = self.db.collection('customers')
 
     def find_customer_by_address(self, address: str):
@@ -43,54 +97,151 @@ class CustomerService:
         if not address or address == 'No encontrado':
             return None
 
+        with _address_lock(address):
+            return self._upsert_customer_locked(address, data, source_type)
+
+    def _upsert_customer_locked(self, address: str, data: dict, source_type: str):
+        """Cuerpo de upsert_customer; se llama con el candado de la dirección tomado."""
         existing_customer = self.find_customer_by_address(address)
 
         if existing_customer:
-            logger.info(f"Cliente encontrado en Firestore ({existing_customer['id']}). Verificando actualizaciones desde '{source_type}'.")
-            update_data = {}
-
-            if source_type == 'delivery_report':
-                new_commercial_name = data.get('commercial_entity')
-                if new_commercial_name and new_commercial_name != existing_customer.get('commercial_name'):
-                    update_data['commercial_name'] = new_commercial_name
-
-                new_instructions = data.get('delivery_instructions')
-                if new_instructions and new_instructions != 'No encontrado' and new_instructions != existing_customer.get('delivery_instructions'):
-                    update_data['delivery_instructions'] = new_instructions
-            
-            elif source_type == 'invoice':
-                new_client_name = data.get('client_name')
-                if new_client_name and new_client_name != existing_customer.get('client_name'):
-                    update_data['client_name'] = new_client_name
+            logger.debug("Cliente encontrado en Firestore (%s). Verificando actualizaciones desde '%s'.", existing_customer['id'], source_type)
+            update_data = _build_update_data(existing_customer, data, source_type)
 
             if update_data:
                 update_data['last_updated_at'] = firestore.SERVER_TIMESTAMP
                 self.collection_ref.document(existing_customer['id']).update(update_data)
-                logger.info(f"Cambios detectados. Actualizando cliente: {update_data}")
+                logger.debug("Cambios detectados. Actualizando cliente: %s", update_data)
                 # Devolver el estado actualizado del cliente
                 updated_customer_data = self.collection_ref.document(existing_customer['id']).get().to_dict()
                 updated_customer_data['id'] = existing_customer['id']
                 return updated_customer_data
             else:
-                logger.info("No se detectaron cambios. Se omite la escritura en la base de datos.")
+                logger.debug("No se detectaron cambios. Se omite la escritura en la base de datos.")
                 return existing_customer
 
         else:
             # --- Cliente Nuevo: Crear registro --- 
-            logger.info(f"Cliente nuevo. Creando entrada en Firestore desde '{source_type}'.")
+            logger.debug("Cliente nuevo. Creando entrada en Firestore desde '%s'.", source_type)
             new_customer_id = uuid4().hex
             coordinates = geocode_address(address)
             
-            new_customer = {
-                'id': new_customer_id,
-                'address': address,
-                'coordinates': coordinates,
-                'client_name': data.get('client_name') if source_type == 'invoice' else None,
-                'commercial_name': data.get('commercial_entity') if source_type == 'delivery_report' else None,
-                'delivery_instructions': data.get('delivery_instructions') if source_type == 'delivery_report' else None,
-                'created_at': firestore.SERVER_TIMESTAMP,
-                'last_updated_at': firestore.SERVER_TIMESTAMP
-            }
+            new_customer = _build_new_customer(new_customer_id, address, coordinates, data, source_type)
             
             self.collection_ref.document(new_customer_id).set(new_customer)
-            return new_customer
\ No newline at end of file
+            return new_customer
+
+    def _find_customers_by_addresses(self, addresses: list) -> dict:
+        """
+        Busca los clientes de varias direcciones con consultas 'in' de hasta 30 valores, en paralelo.
+        Devuelve un diccionario dirección -> datos del cliente (con su ID).
+        """
+        chunks = [addresses[i:i + FIRESTORE_IN_QUERY_LIMIT] for i in range(0, len(addresses), FIRESTORE_IN_QUERY_LIMIT)]
+
+        def fetch_chunk(chunk):
+            query = self.collection_ref.where(filter=FieldFilter('address', 'in', chunk))
+            return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+        customers_by_address = {}
+        with ThreadPoolExecutor(max_workers=min(CUSTOMER_BULK_WORKERS, len(chunks))) as executor:
+            for docs in executor.map(fetch_chunk, chunks):
+                for doc_id, customer_data in docs:
+                    customer_data['id'] = doc_id
+                    # Igual que find_customer_by_address: si hay duplicados, se conserva el primero.
+                    customers_by_address.setdefault(customer_data.get('address'), customer_data)
+        return customers_by_address
+
+    def bulk_upsert(self, items: list, source_type: str) -> list:
+        """
+        Crea o actualiza los clientes de varios ítems con lecturas y escrituras por lotes.
+        Equivale a llamar a upsert_customer por cada ítem en orden: los ítems de una misma
+        dirección se aplican sobre el mismo cliente.
+
+        :param items: Lista de diccionarios con la dirección ('delivery_address' o 'address') y sus datos
+        :param source_type: 'delivery_report' o 'invoice'
+        :return: Lista con los datos del cliente de cada ítem (None si la dirección no es válida), en el orden recibido
+        """
+        item_addresses = []
+        for data in items:
+            address = data.get('delivery_address') or data.get('address')
+            item_addresses.append(address if address and address != 'No encontrado' else None)
+
+        unique_addresses = list(dict.fromkeys(address for address in item_addresses if address))
+        if not unique_addresses:
+            return [None] * len(items)
+
+        customers_by_address = self._find_customers_by_addresses(unique_addresses)
+
+        # Los clientes nuevos se geocodifican en paralelo antes de armar sus documentos.
+        new_addresses = [address for address in unique_addresses if address not in customers_by_address]
+        coordinates_by_address = {}
+        if new_addresses:
+            with ThreadPoolExecutor(max_workers=min(CUSTOMER_BULK_WORKERS, len(new_addresses))) as executor:
+                coordinates_by_address = dict(zip(new_addresses, executor.map(geocode_address, new_addresses)))
+
+        # Las direcciones nuevas se vuelven a buscar con sus candados tomados, igual que en upsert_customer:
+        # si otra llamada creó el cliente mientras se geocodificaba, se actualiza en lugar de duplicarlo.
+        # Los candados se mantienen hasta guardar los clientes nuevos.
+        with _address_locks_for(new_addresses):
+            if new_addresses:
+                customers_by_address.update(self._find_customers_by_addresses(new_addresses))
+
+            new_customer_ids = set()
+            updates_by_id = {}
+            results = []
+            for data, address in zip(items, item_addresses):
+                if not address:
+                    results.append(None)
+                    continue
+
+                customer = customers_by_address.get(address)
+                if customer is None:
+                    logger.debug("Cliente nuevo. Creando entrada en Firestore desde '%s'.", source_type)
+                    customer = _build_new_customer(uuid4().hex, address, coordinates_by_address.get(address), data, source_type)
+                    customers_by_address[address] = customer
+                    new_customer_ids.add(customer['id'])
+                else:
+                    update_data = _build_update_data(customer, data, source_type)
+                    if update_data:
+                        update_data['last_updated_at'] = firestore.SERVER_TIMESTAMP
+                        logger.debug("Cambios detectados. Actualizando cliente: %s", update_data)
+                        customer.update(update_data)
+                        # Un cliente nuevo se escribe completo al final; uno existente acumula sus cambios.
+                        if customer['id'] not in new_customer_ids:
+                            updates_by_id.setdefault(customer['id'], {}).update(update_data)
+
+                results.append(dict(customer))
+
+            writes = [('set', customer['id'], customer) for customer in customers_by_address.values()
+                      if customer['id'] in new_customer_ids]
+            writes += [('update', customer_id, update_data) for customer_id, update_data in updates_by_id.items()]
+
+            for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+                batch = self.db.batch()
+                for operation, customer_id, document in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+                    doc_ref = self.collection_ref.document(customer_id)
+                    if operation == 'set':
+                        batch.set(doc_ref, document)
+                    else:
+                        batch.update(doc_ref, document)
+                batch.commit()
+
+        logger.info(f"Clientes procesados por lotes: {len(new_customer_ids)} nuevos, {len(updates_by_id)} actualizados.")
+        return results
+
+# Instancia compartida: el servicio no guarda estado por petición y el cliente de Firestore es thread-safe.
+_customer_service = None
+_customer_service_lock = threading.Lock()
+
+def get_customer_service() -> CustomerService:
+    """
+    Devuelve el CustomerService compartido, creándolo en el primer uso.
+
+    :raises: ConnectionError si Firebase Admin no está inicializado
+    """
+    global _customer_service
+    if _customer_service is None:
+        with _customer_service_lock:
+            if _customer_service is None:
+                _customer_service = CustomerService()
+    return _customer_service
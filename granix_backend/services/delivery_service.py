@@ -1,26 +1,64 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
 from uuid import uuid4
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
-from granix_backend.parsing.delivery_parser import DeliveryReportParser
-from granix_backend.services.customer_service import CustomerService
+from granix_backend.db import get_db
+from granix_backend.parsing.delivery_parser import DeliveryReportParser, DeliveryItem
+from granix_backend.services.customer_service import get_customer_service
 from granix_backend.optimization.route_optimizer import optimize_route, get_street_level_route
+from granix_backend.utils.shared_utils import normalize_coordinates, FIRESTORE_IN_QUERY_LIMIT, FIRESTORE_BATCH_LIMIT
 
 # Configurar logger para delivery_service.py
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+def _fetch_delivery_items_by_address(db, addresses: list) -> dict:
+    """
+    Obtiene los delivery_items de las direcciones indicadas, indexados por dirección.
+    Las direcciones se dividen en grupos de hasta 30 y las consultas se ejecutan en paralelo.
+    Si una dirección tiene varios items, se prefiere uno ya vinculado a su factura.
+    """
+    delivery_items_ref = db.collection('delivery_items')
+    chunks = [addresses[i:i + FIRESTORE_IN_QUERY_LIMIT] for i in range(0, len(addresses), FIRESTORE_IN_QUERY_LIMIT)]
+
+    def fetch_chunk(chunk):
+        query = delivery_items_ref.where(filter=FieldFilter('delivery_address', 'in', chunk))
+        return [doc.to_dict() for doc in query.stream()]
+
+    delivery_items_map = {}
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        for docs in executor.map(fetch_chunk, chunks):
+            for doc_data in docs:
+                address = doc_data.get('delivery_address')
+                if address not in delivery_items_map or doc_data.get('status') == 'linked':
+                    delivery_items_map[address] = doc_data
+    return delivery_items_map
+
+def _save_delivery_items(db, pending_writes: list) -> None:
+    """
+    Guarda los delivery_items con WriteBatch (hasta 500 por lote) en lugar de una escritura por ítem.
+
+    :param pending_writes: Lista de tuplas (delivery_item_id, documento)
+    """
+    delivery_items_ref = db.collection('delivery_items')
+    for start in range(0, len(pending_writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for delivery_item_id, delivery_item_doc in pending_writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(delivery_items_ref.document(delivery_item_id), delivery_item_doc)
+        batch.commit()
+
+    for delivery_item_id, delivery_item_doc in pending_writes:
+        logger.debug("Guardado delivery_item %s para la dirección '%s' con estado '%s'",
+                    delivery_item_id, delivery_item_doc['delivery_address'], delivery_item_doc['status'])
 
 def process_delivery_report_data(raw_ocr_text: str) -> dict:
     """
     Procesa un informe de reparto, guarda ítems, optimiza la ruta y genera la lista de carga LIFO.
     """
-    db = firestore.client()
+    db = get_db()
     parser = DeliveryReportParser()
-    customer_service = CustomerService()
+    customer_service = get_customer_service()
     
     parsed_data = parser.parse_delivery_report_text(raw_ocr_text)
     delivery_items = parsed_data.get('delivery_items', [])
@@ -28,52 +66,51 @@ def process_delivery_report_data(raw_ocr_text: str) -> dict:
     if not delivery_items:
         return parsed_data
 
-    processed_items = []
-    # 1. Guardar/actualizar clientes y guardar cada delivery_item individualmente
-    for item in delivery_items:
-        address = item.get('delivery_address')
-        if not address or address == 'No encontrado':
-            continue
-
-        item['address'] = address
-        customer_data = customer_service.upsert_customer(item, 'delivery_report')
-        
+    # 1. Guardar/actualizar clientes y preparar cada delivery_item para la escritura por lotes
+    def prepare_item(item: DeliveryItem, customer_data: dict) -> tuple:
         # Asignar datos del cliente y coordenadas si están disponibles
         if customer_data and customer_data.get('id'):
-            item['customer_id'] = customer_data['id']
+            item.customer_id = customer_data['id']
             if customer_data.get('coordinates'):
-                item['coordinates'] = customer_data['coordinates']
+                item.coordinates = customer_data['coordinates']
 
-        # Verificar si la geocodificación falló
-        coordinates = item.get('coordinates')
-        if not coordinates or coordinates.get('latitude') is None or coordinates.get('longitude') is None:
-            item['status'] = 'review_required'
-            item['error_notes'] = "Error de geocodificación. Requiere revisión manual."
+        # Las coordenadas del cliente se conservan tal cual en la respuesta; el estado se decide con una sola comprobación.
+        if normalize_coordinates(item.coordinates) is None:
+            item.status = 'review_required'
+            item.error_notes = "Error de geocodificación. Requiere revisión manual."
         else:
-            item['status'] = 'pending_link'
+            item.status = 'pending_link'
 
         # Preparar un documento limpio para Firestore
         delivery_item_doc = {
-            'delivery_address': address,
-            'commercial_entity': item.get('commercial_entity'),
-            'packages': item.get('packages'),
-            'delivery_instructions': item.get('delivery_instructions'),
-            'customer_id': item.get('customer_id'),
+            'delivery_address': item.delivery_address,
+            'commercial_entity': item.commercial_entity,
+            'packages': item.packages,
+            'delivery_instructions': item.delivery_instructions,
+            'customer_id': item.customer_id,
             'createdAt': firestore.SERVER_TIMESTAMP,
-            'status': item['status']
+            'status': item.status
         }
-        if 'error_notes' in item:
-            delivery_item_doc['error_notes'] = item['error_notes']
+        if item.error_notes is not None:
+            delivery_item_doc['error_notes'] = item.error_notes
+
+        return uuid4().hex, delivery_item_doc
 
-        delivery_item_id = uuid4().hex
-        db.collection('delivery_items').document(delivery_item_id).set(delivery_item_doc)
-        logger.info(f"Guardado delivery_item {delivery_item_id} para la dirección '{address}' con estado '{item['status']}'")
-        processed_items.append(item)
+    processed_items = [
+        item for item in delivery_items
+        if item.delivery_address and item.delivery_address != 'No encontrado'
+    ]
+
+    if processed_items:
+        # Una lectura por cada 30 direcciones y escrituras por lotes, en lugar de leer y escribir por ítem.
+        customers = customer_service.bulk_upsert([asdict(item) for item in processed_items], 'delivery_report')
+        pending_writes = [prepare_item(item, customer_data) for item, customer_data in zip(processed_items, customers)]
+        _save_delivery_items(db, pending_writes)
 
     # 2. Optimizar la ruta de entrega, excluyendo los que requieren revisión
     valid_stops_for_optimization = [
-        item for item in processed_items 
-        if item.get('status') != 'review_required' and 'coordinates' in item and item['coordinates'].get('latitude') is not None
+        item.to_dict() for item in processed_items
+        if item.status == 'pending_link'
     ]
     
     if valid_stops_for_optimization:
@@ -82,22 +119,21 @@ def process_delivery_report_data(raw_ocr_text: str) -> dict:
         parsed_data['optimized_route'] = optimized_route
 
         if optimized_route:
-            street_level_polyline = get_street_level_route(optimized_route)
-            parsed_data['street_level_polyline'] = street_level_polyline
-            
             # --- Lógica de Carga LIFO Refactorizada ---
             logger.info("Generando lista de carga LIFO a partir de la ruta optimizada.")
             optimized_loading_list = optimized_route[::-1]
             
-            addresses = [stop['address'] for stop in optimized_loading_list if 'address' in stop]
+            addresses = list(dict.fromkeys(stop['address'] for stop in optimized_loading_list if 'address' in stop))
+
+            # La polilínea de OSRM y la lectura de Firestore no dependen entre sí: se ejecutan en paralelo.
+            # La lectura trae también los items ya vinculados a una factura (por ejemplo, de días anteriores),
+            # que aportan el cliente y los productos a la lista de carga.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                polyline_future = executor.submit(get_street_level_route, optimized_route)
+                delivery_items_map = _fetch_delivery_items_by_address(db, addresses) if addresses else {}
+                parsed_data['street_level_polyline'] = polyline_future.result()
             
             if addresses:
-                delivery_items_ref = db.collection('delivery_items')
-                # La consulta ahora puede buscar items que están listos para ser vinculados o ya vinculados
-                delivery_query = delivery_items_ref.where(filter=FieldFilter('delivery_address', 'in', addresses))
-                
-                delivery_items_map = {doc.to_dict()['delivery_address']: doc.to_dict() for doc in delivery_query.stream()}
-                
                 for stop in optimized_loading_list:
                     stop_address = stop.get('address')
                     linked_item = delivery_items_map.get(stop_address)
@@ -121,5 +157,7 @@ def process_delivery_report_data(raw_ocr_text: str) -> dict:
         parsed_data['street_level_polyline'] = []
         parsed_data['optimized_loading_list'] = []
 
+    # La respuesta JSON mantiene el formato de diccionario de los ítems (con 'address' y sin campos en null).
+    parsed_data['delivery_items'] = [item.to_dict() for item in delivery_items]
     return parsed_data
 
@@ -1,19 +1,44 @@
+import os
 import re
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from uuid import uuid4
 import logging
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter, And
-from granix_backend.services.customer_service import CustomerService
-from granix_backend.utils.shared_utils import extract_text_from_image, upload_image_to_cloudinary, save_invoice_data
+from granix_backend.db import get_db
+from granix_backend.services.customer_service import get_customer_service
+from granix_backend.utils.shared_utils import extract_text_from_image, upload_image_to_cloudinary, delete_image_from_cloudinary, save_invoice_data, FIRESTORE_BATCH_LIMIT
 
 # Configurar logger para invoice_service.py
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+# Máximo de facturas procesadas en paralelo; acota también la concurrencia contra Cloudinary y Nominatim.
+INVOICE_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+# Pool compartido para las subidas a Cloudinary: acota las subidas simultáneas aunque se procesen
+# varias facturas o páginas a la vez.
+CLOUDINARY_UPLOAD_WORKERS = 3
+_upload_executor = ThreadPoolExecutor(max_workers=CLOUDINARY_UPLOAD_WORKERS, thread_name_prefix='cloudinary-upload')
+
+# Expresiones regulares del parseo de facturas, compiladas una sola vez al importar el módulo.
+_CLIENT_ADDRESS_RE = re.compile(r'Sr/Sres\.\s*Cliente[^\n]+\n(.*?)\s*Ven\.:[^\n]*\n(.*?)\s*Transp\.:', re.DOTALL)
+_TOTAL_RE = re.compile(r'IMPORTE TOTAL\s+\$[\s]*([\d.,]+)')
+_PRODUCT_BLOCK_RE = re.compile(r'Articulo\s+Cantidad\s+Descripci.n[\s\S]+?(?=Subtotal|IMPORTE TOTAL)', re.DOTALL)
+# Una línea de producto por coincidencia: los espacios ([^\S\n]) no cruzan saltos de línea.
+_PRODUCT_LINE_RE = re.compile(
+    r'^[^\S\n]*(\d{4,5})[^\S\n]+(\d+)[^\S\n]+(.+?)[^\S\n]+([\d.,]+(?:,\d{2})?)[^\S\n]+([\d.,]+(?:,\d{2})?)[^\S\n]*$',
+    re.MULTILINE
+)
+# Ruido de la dirección en una sola pasada: el prefijo "N°" y los saltos de línea pasan a espacio
+# y los '?' del OCR se eliminan; después se colapsan los espacios repetidos.
+_ADDRESS_NOISE_RE = re.compile(r'(?<![a-zA-Z])N[\u00b0*\s]+\s*|[?\n]', re.IGNORECASE)
+_MULTISPACE_RE = re.compile(r'\s{2,}')
+
+# Montos en formato argentino (1.234,56): una sola pasada con str.translate en lugar de varios replace.
+_NUMBER_PARSE_TABLE = str.maketrans({'.': '', ',': '.'})
+_AMOUNT_FORMAT_TABLE = str.maketrans({',': '.', '.': ','})
 
 def _link_to_delivery_by_address(invoice_id: str, address: str, client_name: str, product_items: list, invoice_date: datetime):
     """
@@ -24,7 +49,7 @@ def _link_to_delivery_by_address(invoice_id: str, address: str, client_name: str
         logger.warning(f"Dirección inválida para la factura {invoice_id}. No se puede vincular.")
         return
 
-    db = firestore.client()
+    db = get_db()
     delivery_items_ref = db.collection('delivery_items')
 
     # Busca el item de delivery más antiguo con estado 'pending_link' para la misma dirección.
@@ -40,75 +65,135 @@ def _link_to_delivery_by_address(invoice_id: str, address: str, client_name: str
         .limit(1)
     )
     
-    docs = query.stream()
-    
+    update_data = {
+        'invoice_id': invoice_id,
+        'client_name': client_name,
+        'product_items': product_items,
+        'status': 'linked',
+        'linkedAt': firestore.SERVER_TIMESTAMP
+    }
+
     try:
-        doc = next(docs)
-        logger.info(f"Vinculando factura {invoice_id} con delivery_item {doc.id} por dirección y tiempo.")
-        
-        doc.reference.update({
-            'invoice_id': invoice_id,
-            'client_name': client_name,
-            'product_items': product_items,
-            'status': 'linked',
-            'linkedAt': firestore.SERVER_TIMESTAMP
-        })
-        logger.info(f"Vinculación por dirección y tiempo exitosa: {doc.id} -> {invoice_id}")
-
-    except StopIteration:
-        logger.warning(f"No se encontró un delivery_item pendiente para la dirección '{address}' en la ventana de tiempo. Se omite la vinculación.")
+        delivery_item_id = _claim_pending_delivery_item(db.transaction(), query, update_data)
     except Exception as e:
         logger.error(f"Error al vincular por dirección y tiempo para '{address}': {e}")
+        return
 
-def _process_invoice_image_data(image_path: str) -> dict:
+    if delivery_item_id is None:
+        logger.warning(f"No se encontró un delivery_item pendiente para la dirección '{address}' en la ventana de tiempo. Se omite la vinculación.")
+        return
+    logger.debug("Vinculación por dirección y tiempo exitosa: %s -> %s", delivery_item_id, invoice_id)
+
+@firestore.transactional
+def _claim_pending_delivery_item(transaction, query, update_data: dict):
+    """
+    Lee el delivery_item pendiente y lo marca como vinculado dentro de una transacción: si otra
+    factura lo vincula entre la lectura y la escritura, Firestore reintenta y la consulta ya no lo devuelve.
+
+    :return: ID del delivery_item vinculado, o None si no hay ninguno pendiente
+    """
+    for doc in transaction.get(query):
+        transaction.update(doc.reference, update_data)
+        return doc.id
+    return None
+
+def _discard_upload(upload_future) -> None:
+    """
+    Descarta la subida a Cloudinary de una factura que no se va a guardar: la cancela si todavía
+    no empezó o, si ya terminó, borra la imagen subida.
+    """
+    if upload_future.cancel():
+        return
+    try:
+        _, public_id = upload_future.result()
+    except Exception:
+        return  # La subida falló: no quedó ninguna imagen en Cloudinary.
+    delete_image_from_cloudinary(public_id)
+
+def _discard_invoice_uploads(pending_writes: list, invoice_ids: set | None = None) -> None:
+    """
+    Borra de Cloudinary las imágenes de facturas que quedaron sin guardar en Firestore.
+
+    :param pending_writes: Lista de tuplas (invoice_id, datos) armada por _process_invoice_image_data
+    :param invoice_ids: Si se indica, solo se borran las imágenes de esas facturas
+    """
+    for invoice_id, firestore_data in pending_writes:
+        if invoice_ids is None or invoice_id in invoice_ids:
+            delete_image_from_cloudinary(firestore_data["cloudinaryPublicId"])
+
+def _process_invoice_image_data(image_path: str, pending_writes: list | None = None, pending_links: list | None = None) -> dict:
     """
     Procesa una imagen de factura: OCR, parseo, subida a Cloudinary, guardado y vinculación.
+
+    :param image_path: Ruta de la imagen de la factura
+    :param pending_writes: Si se indica, el documento de la factura se agrega a esta lista como
+        (invoice_id, datos) para guardarlo por lotes, en lugar de escribirlo de inmediato
+    :param pending_links: Si se indica, la vinculación con el delivery_item se agrega a esta lista como
+        (invoice_id, argumentos) para hacerla después de guardar la factura, en lugar de vincular de inmediato
     """
-    processing_time = datetime.now()
-    raw_ocr_text = extract_text_from_image(image_path)
-    parsed_data = parse_invoice_text(raw_ocr_text)
-    
-    client_name = parsed_data.get("client_name", "Cliente no encontrado")
-    address = parsed_data.get("address", "Dirección no encontrada")
-    total_amount = parsed_data.get("total_amount")
-    product_items = parsed_data.get("product_items", [])
+    # Una sola marca de tiempo, con zona UTC explícita: Firestore interpreta las fechas sin zona como UTC.
+    processing_time = datetime.now(timezone.utc)
 
-    cloudinary_url = upload_image_to_cloudinary(image_path)
-    
-    customer_service = CustomerService()
-    customer_data = customer_service.upsert_customer(parsed_data, 'invoice')
-    
-    coordinates = {"latitude": None, "longitude": None}
-    if customer_data and customer_data.get('coordinates'):
-        coordinates = customer_data['coordinates']
-
-    invoice_id = uuid4().hex
-    firestore_data = {
-        "cloudinaryImageUrl":cloudinary_url,
-        "uploadedAt": processing_time,
-        "rawOcrText": raw_ocr_text,
-        "parsedData": parsed_data,
-        "location": {
-            "address": address,
-            "latitude": coordinates["latitude"],
-            "longitude": coordinates["longitude"]
-        },
-        "status": "processed",
-        "processedAt": processing_time
-    }
-    save_invoice_data(invoice_id, firestore_data)
-    logger.info(f"[Invoice:{invoice_id}] Procesamiento completo para la factura.")
+    # La subida a Cloudinary no depende del OCR ni del cliente: corre en el pool de subidas
+    # mientras Tesseract lee la imagen y se actualiza el cliente, y se espera recién al guardar.
+    # Si algo falla antes de guardar, la subida se cancela o la imagen se borra para no dejarla huérfana.
+    upload_future = _upload_executor.submit(upload_image_to_cloudinary, image_path)
+    try:
+        raw_ocr_text = extract_text_from_image(image_path)
+        parsed_data = parse_invoice_text(raw_ocr_text)
+        
+        client_name = parsed_data.get("client_name", "Cliente no encontrado")
+        address = parsed_data.get("address", "Dirección no encontrada")
+        total_amount = parsed_data.get("total_amount")
+        product_items = parsed_data.get("product_items", [])
+        
+        customer_service = get_customer_service()
+        customer_data = customer_service.upsert_customer(parsed_data, 'invoice')
+        
+        coordinates = {"latitude": None, "longitude": None}
+        if customer_data and customer_data.get('coordinates'):
+            coordinates = customer_data['coordinates']
+
+        cloudinary_url, cloudinary_public_id = upload_future.result()
+
+        invoice_id = uuid4().hex
+        firestore_data = {
+            "cloudinaryImageUrl":cloudinary_url,
+            "cloudinaryPublicId": cloudinary_public_id,
+            "uploadedAt": processing_time,
+            "rawOcrText": raw_ocr_text,
+            "parsedData": parsed_data,
+            "location": {
+                "address": address,
+                "latitude": coordinates["latitude"],
+                "longitude": coordinates["longitude"]
+            },
+            "status": "processed",
+            "processedAt": processing_time
+        }
+        if pending_writes is None:
+            save_invoice_data(invoice_id, firestore_data)
+        else:
+            pending_writes.append((invoice_id, firestore_data))
+    except Exception:
+        _discard_upload(upload_future)
+        raise
+    logger.debug("[Invoice:%s] Procesamiento completo para la factura.", invoice_id)
 
     # --- Lógica de Vinculación por Dirección y Tiempo ---
-    _link_to_delivery_by_address(
-        invoice_id=invoice_id,
-        address=address,
-        client_name=client_name,
-        product_items=product_items,
-        invoice_date=processing_time
-    )
+    link_args = {
+        "invoice_id": invoice_id,
+        "address": address,
+        "client_name": client_name,
+        "product_items": product_items,
+        "invoice_date": processing_time
+    }
+    if pending_links is None:
+        _link_to_delivery_by_address(**link_args)
+    else:
+        pending_links.append((invoice_id, link_args))
     
-    formatted_total_amount = f'$ {total_amount:,.2f}'.replace(",", "X").replace(".", ",").replace("X", ".") if total_amount is not None else None
+    formatted_total_amount = f'$ {total_amount:,.2f}'.translate(_AMOUNT_FORMAT_TABLE) if total_amount is not None else None
     
     return {
         "invoice_id": invoice_id,
@@ -122,6 +207,10 @@ def _process_invoice_image_data(image_path: str) -> dict:
         "status": "processed"
     }
 
+def _address_noise_replacement(match) -> str:
+    """Reemplazo de _ADDRESS_NOISE_RE: los '?' se eliminan y el resto pasa a un espacio."""
+    return '' if match.group() == '?' else ' '
+
 def parse_invoice_text(raw_ocr_text: str) -> dict:
     """
     Extrae datos estructurados del texto OCR de una factura.
@@ -131,54 +220,45 @@ def parse_invoice_text(raw_ocr_text: str) -> dict:
     total_amount = None
     product_items = []
 
-    client_address_pattern = r'Sr/Sres\.\s*Cliente[^\n]+\n(.*?)\s*Ven\.:[^\n]*\n(.*?)\s*Transp\.:'
-    match_client_address = re.search(client_address_pattern, raw_ocr_text, re.DOTALL)
+    match_client_address = _CLIENT_ADDRESS_RE.search(raw_ocr_text)
 
     if match_client_address:
         try:
             client_name = match_client_address.group(1).strip()
-            address = match_client_address.group(2).strip().replace('\n', ' ')
-            address = re.sub(r'(?<![a-zA-Z])N[\u00b0*\s]+\s*', ' ', address, flags=re.IGNORECASE).strip()
-            address = address.replace('?', '').strip()
-            address = re.sub(r'\s{2,}', ' ', address).strip()
-            address = address.title()
+            address = _ADDRESS_NOISE_RE.sub(_address_noise_replacement, match_client_address.group(2).strip())
+            address = _MULTISPACE_RE.sub(' ', address).strip().title()
         except IndexError:
             pass
 
-    total_amount_pattern = r'IMPORTE TOTAL\s+\$[\s]*([\d.,]+)'
-    match_total = re.search(total_amount_pattern, raw_ocr_text)
+    match_total = _TOTAL_RE.search(raw_ocr_text)
     if match_total:
         try:
-            total_amount = float(match_total.group(1).replace('.', '').replace(',', '.'))
+            total_amount = float(match_total.group(1).translate(_NUMBER_PARSE_TABLE))
         except (ValueError, IndexError):
             pass
 
-    product_block_pattern = r'Articulo\s+Cantidad\s+Descripci.n[\s\S]+?(?=Subtotal|IMPORTE TOTAL)'
-    product_block_match = re.search(product_block_pattern, raw_ocr_text, re.DOTALL)
+    product_block_match = _PRODUCT_BLOCK_RE.search(raw_ocr_text)
     
     product_table_text = ""
     if product_block_match:
         product_table_text = product_block_match.group(0)
 
-    product_line_pattern = r'^(\d{4,5})\s+(\d+)\s+(.+?)\s+([\d.,]+(?:,\d{2})?)\s+([\d.,]+(?:,\d{2})?)$'
-
-    for line in product_table_text.split('\n'):
-        line_match = re.match(product_line_pattern, line.strip())
-        if line_match:
-            try:
-                product_code = line_match.group(1)
-                quantity = int(line_match.group(2))
-                description = line_match.group(3).strip()
-                item_total = float(line_match.group(5).replace('.', '').replace(',', '.'))
-
-                product_items.append({
-                    "product_code": product_code,
-                    "quantity": quantity,
-                    "description": description,
-                    "item_total": item_total,
-                })
-            except (ValueError, IndexError):
-                pass
+    # Una sola pasada del motor de regex sobre el bloque, sin dividirlo en líneas.
+    for line_match in _PRODUCT_LINE_RE.finditer(product_table_text):
+        try:
+            product_code = line_match.group(1)
+            quantity = int(line_match.group(2))
+            description = line_match.group(3).strip()
+            item_total = float(line_match.group(5).translate(_NUMBER_PARSE_TABLE))
+
+            product_items.append({
+                "product_code": product_code,
+                "quantity": quantity,
+                "description": description,
+                "item_total": item_total,
+            })
+        except (ValueError, IndexError):
+            pass
 
     return {
         "client_name": client_name,
@@ -187,26 +267,88 @@ def parse_invoice_text(raw_ocr_text: str) -> dict:
         "product_items": product_items,
     }
 
-def process_invoices(image_paths: list) -> list:
+def _process_invoice_safely(image_path: str, pending_writes: list | None = None, pending_links: list | None = None) -> dict:
+    """Procesa una factura y, si falla, devuelve un resultado con estado 'error' en lugar de propagar la excepción."""
+    try:
+        return _process_invoice_image_data(image_path, pending_writes, pending_links)
+    except Exception as e:
+        logger.error(f"Error procesando la factura {image_path}: {e}")
+        return _error_result()
+
+def _error_result() -> dict:
+    """Resultado de una factura que no se pudo procesar."""
+    return {
+        "invoice_id": None,
+        "url": None,
+        "raw_ocr_text": "",
+        "product_items": [],
+        "total_amount": None,
+        "client_name": "Error en procesamiento",
+        "parsed_data": {},
+        "coordinates": {"latitude": None, "longitude": None},
+        "status": "error"
+    }
+
+def _save_invoices(pending_writes: list) -> set:
     """
-    Procesa una lista de rutas de imágenes de facturas.
+    Guarda las facturas con WriteBatch (hasta 500 por lote) en lugar de una escritura por factura.
+
+    :param pending_writes: Lista de tuplas (invoice_id, datos)
+    :return: IDs de las facturas cuyo lote no se pudo guardar
     """
-    processed_invoices = []
-    for image_path in image_paths:
+    failed_invoice_ids = set()
+    db = get_db()
+    for start in range(0, len(pending_writes), FIRESTORE_BATCH_LIMIT):
+        chunk = pending_writes[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = db.batch()
+        for invoice_id, firestore_data in chunk:
+            save_invoice_data(invoice_id, firestore_data, batch=batch)
         try:
-            result = _process_invoice_image_data(image_path)
-            processed_invoices.append(result)
+            batch.commit()
+            logger.info(f"Guardadas {len(chunk)} facturas en Firestore en un solo lote.")
         except Exception as e:
-            logger.error(f"Error procesando la factura {image_path}: {e}")
-            processed_invoices.append({
-                "invoice_id": None,
-                "url": None,
-                "raw_ocr_text": "",
-                "product_items": [],
-                "total_amount": None,
-                "client_name": "Error en procesamiento",
-                "parsed_data": {},
-                "coordinates": {"latitude": None, "longitude": None},
-                "status": "error"
-            })
+            logger.error(f"Error al guardar un lote de {len(chunk)} facturas en Firestore: {e}")
+            failed_invoice_ids.update(invoice_id for invoice_id, _ in chunk)
+    return failed_invoice_ids
+
+def _link_saved_invoices(pending_links: list, failed_invoice_ids: set) -> None:
+    """
+    Vincula con sus delivery_items las facturas que se guardaron, una por vez.
+    Las de un lote que no se pudo guardar no se vinculan: el delivery_item quedaría apuntando
+    a una factura inexistente.
+
+    :param pending_links: Lista de tuplas (invoice_id, argumentos de _link_to_delivery_by_address)
+    :param failed_invoice_ids: IDs devueltos por _save_invoices
+    """
+    for invoice_id, link_args in pending_links:
+        if invoice_id not in failed_invoice_ids:
+            _link_to_delivery_by_address(**link_args)
+
+def process_invoices(image_paths: list) -> list:
+    """
+    Procesa una lista de rutas de imágenes de facturas.
+    Las facturas se procesan en paralelo (OCR, Cloudinary y Firestore liberan el GIL)
+    y los resultados se devuelven en el mismo orden que las rutas recibidas.
+    Los documentos de las facturas se guardan al final por lotes y solo después se vinculan
+    con los delivery_items.
+    """
+    if not image_paths:
+        return []
+
+    pending_writes = []
+    pending_links = []
+    with ThreadPoolExecutor(max_workers=min(INVOICE_WORKERS, len(image_paths))) as executor:
+        processed_invoices = list(executor.map(
+            partial(_process_invoice_safely, pending_writes=pending_writes, pending_links=pending_links),
+            image_paths
+        ))
+
+    failed_invoice_ids = _save_invoices(pending_writes)
+    _link_saved_invoices(pending_links, failed_invoice_ids)
+    if failed_invoice_ids:
+        _discard_invoice_uploads(pending_writes, failed_invoice_ids)
+        processed_invoices = [
+            _error_result() if result.get("invoice_id") in failed_invoice_ids else result
+            for result in processed_invoices
+        ]
     return processed_invoices
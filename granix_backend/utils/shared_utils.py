@@ -1,26 +1,40 @@
 import os
+import shutil
 import tempfile
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
 import cloudinary
 import cloudinary.uploader
+from cloudinary.exceptions import AlreadyExists, AuthorizationRequired, BadRequest, NotAllowed, NotFound
 from PIL import Image
-import pytesseract
 import re
 from pdf2image import convert_from_path
 from contextlib import contextmanager
-import io
+import hashlib
+import threading
+import time
+import unicodedata
 import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
 
+# Las páginas ya se procesan en paralelo: cada llamada a Tesseract usa un solo hilo de OpenMP para no
+# sobresuscribir los núcleos. Se fija antes de cargar tesserocr (y lo heredan los procesos de pytesseract).
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:  # tesserocr es opcional: sin él se invoca el binario de tesseract con pytesseract.
+    PyTessBaseAPI = None
+
+from granix_backend.db import get_db
+
 # Configurar logger para shared_utils.py
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 # Carga variables de entorno desde .env si existe
 load_dotenv()
@@ -28,6 +42,87 @@ load_dotenv()
 # Dirección de respaldo para geocodificación fallida
 DEFAULT_START_ADDRESS = "Mendoza y Wilde, Rosario, Santa Fe, Argentina"
 
+# Tamaño del buffer al copiar un archivo subido a disco (1 MiB en lugar de los 16 KiB por defecto).
+UPLOAD_COPY_BUFFER_SIZE = 1 << 20
+
+# Hilos (procesos de poppler) usados para rasterizar las páginas de un PDF.
+PDF_RENDER_THREADS = max(1, min(4, os.cpu_count() or 1))
+
+# Resolución de rasterizado de los informes de reparto en PDF, que solo pasan por el OCR: 150 DPI alcanza
+# y Tesseract tarda aproximadamente en proporción a la cantidad de píxeles.
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "150"))
+
+# Las páginas de las facturas PDF además se archivan en Cloudinary: se rasterizan a 200 DPI, como antes,
+# para no perder legibilidad en la copia guardada. Se escriben como JPEG de calidad alta en lugar de PNG.
+INVOICE_PDF_RENDER_DPI = int(os.getenv("INVOICE_PDF_RENDER_DPI", "200"))
+INVOICE_PDF_JPEG_QUALITY = 90
+
+# Hilos para aplicar OCR a las páginas de un PDF en paralelo (configurable con OCR_CONCURRENCY).
+OCR_WORKERS = max(1, int(os.getenv("OCR_CONCURRENCY", os.cpu_count() or 1)))
+
+# Umbral de binarización de las imágenes antes del OCR (los píxeles más claros pasan a blanco).
+OCR_BINARIZE_THRESHOLD = 180
+_BINARIZE_LUT = [0] * OCR_BINARIZE_THRESHOLD + [255] * (256 - OCR_BINARIZE_THRESHOLD)
+
+# Motor y segmentación de Tesseract: solo LSTM (OEM 1) y segmentación automática de página (PSM 3).
+# PSM 6 (un bloque de texto uniforme) es más rápido, pero puede mezclar las columnas de facturas e
+# informes; se activa con TESSERACT_PSM=6 solo cuando esté validado con documentos reales.
+TESSERACT_OEM = int(os.getenv("TESSERACT_OEM", "1"))
+TESSERACT_PSM = int(os.getenv("TESSERACT_PSM", "3"))
+TESSERACT_CONFIG = f"--oem {TESSERACT_OEM} --psm {TESSERACT_PSM}"
+
+# Páginas por archivo de lista al invocar el binario de tesseract una vez por lote
+# (con listas muy largas pytesseract puede quedar colgado).
+TESSERACT_LIST_BATCH_SIZE = 40
+
+# Pool de instancias de tesserocr por idioma, compartido entre peticiones: cada instancia carga los datos
+# del idioma una sola vez y la usa un solo hilo a la vez. El servidor de desarrollo de Werkzeug (con hilos
+# por defecto) atiende cada petición en un hilo nuevo, así que una instancia por hilo se volvería a crear
+# en cada petición.
+OCR_POOL_SIZE = max(1, int(os.getenv("OCR_POOL_SIZE", OCR_WORKERS)))
+_tesseract_pools = {}
+_tesseract_pools_lock = threading.Lock()
+
+# Límites de Firestore: valores por filtro 'in' y operaciones por WriteBatch.
+FIRESTORE_IN_QUERY_LIMIT = 30
+FIRESTORE_BATCH_LIMIT = 500
+
+# Coordenadas del viewbox para Rosario, Argentina: [(sur, oeste), (norte, este)]
+# Esto ayuda a Nominatim a priorizar resultados dentro de esta área.
+ROSARIO_VIEWBOX = [(-33.016, -60.75), (-32.85, -60.6)]
+
+# Geocodificador compartido: su RequestsAdapter mantiene una sesión HTTP con conexiones reutilizables.
+_geolocator = Nominatim(user_agent="granix-backend/1.0", adapter_factory=RequestsAdapter)
+
+# La política de uso de Nominatim admite una consulta por segundo. El RateLimiter es thread-safe, así que
+# las geocodificaciones en paralelo se espacian sin serializar la espera de cada respuesta.
+# Los errores transitorios del servicio (GeocoderServiceError: timeouts, 5xx, cuota) se reintentan
+# antes de dar la dirección por no geocodificada.
+NOMINATIM_MIN_DELAY_SECONDS = 1.0
+NOMINATIM_MAX_RETRIES = 2
+NOMINATIM_ERROR_WAIT_SECONDS = 2.0
+_nominatim_geocode = RateLimiter(
+    _geolocator.geocode,
+    min_delay_seconds=NOMINATIM_MIN_DELAY_SECONDS,
+    max_retries=NOMINATIM_MAX_RETRIES,
+    error_wait_seconds=NOMINATIM_ERROR_WAIT_SECONDS,
+    swallow_exceptions=False
+)
+
+# Reintentos de las subidas a Cloudinary: los errores de red y 5xx se reintentan con espera exponencial;
+# los rechazos del cliente (4xx) fallan de inmediato porque repetirlos no cambia el resultado.
+CLOUDINARY_UPLOAD_ATTEMPTS = 3
+CLOUDINARY_RETRY_BACKOFF_SECONDS = 0.5
+_CLOUDINARY_PERMANENT_ERRORS = (BadRequest, AuthorizationRequired, NotAllowed, NotFound, AlreadyExists)
+
+# Caché de geocodificación: LRU en memoria respaldado por una colección de Firestore.
+GEOCODE_CACHE_COLLECTION = 'geocode_cache'
+GEOCODE_CACHE_MAXSIZE = 4096
+_geocode_memory_cache = OrderedDict()
+_geocode_cache_lock = threading.Lock()
+# Geocodificaciones en curso por clave normalizada, para no consultar dos veces la misma dirección en paralelo.
+_geocode_in_flight = {}
+
 # Configurar Cloudinary (se asume que las variables de entorno ya están cargadas)
 cloudinary.config(
     cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
@@ -56,31 +151,144 @@ except ValueError:
 except Exception as e:
     logger.error(f"Error al inicializar Firebase Admin en shared_utils.py: {e}")
 
+def _normalize_address_key(address_string: str) -> str:
+    """
+    Normaliza una dirección para usarla como clave de caché: minúsculas, sin acentos y con espacios colapsados.
+    """
+    decomposed = unicodedata.normalize('NFKD', address_string)
+    without_accents = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(without_accents.lower().split())
+
+def _get_cached_coordinates(cache_key: str):
+    """
+    Busca coordenadas en la caché en memoria y, si no están, en la colección geocode_cache de Firestore.
+    """
+    with _geocode_cache_lock:
+        coordinates = _geocode_memory_cache.get(cache_key)
+        if coordinates is not None:
+            _geocode_memory_cache.move_to_end(cache_key)
+            return coordinates
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        return None
+
+    try:
+        doc_id = hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
+        doc = get_db().collection(GEOCODE_CACHE_COLLECTION).document(doc_id).get()
+        if not doc.exists:
+            return None
+        coordinates = doc.to_dict().get('coordinates')
+    except Exception as e:
+        logger.warning(f"Error leyendo la caché de geocodificación para '{cache_key}': {e}")
+        return None
+
+    if coordinates:
+        _remember_coordinates(cache_key, coordinates)
+    return coordinates
+
+def _remember_coordinates(cache_key: str, coordinates: dict) -> None:
+    with _geocode_cache_lock:
+        _geocode_memory_cache[cache_key] = coordinates
+        _geocode_memory_cache.move_to_end(cache_key)
+        if len(_geocode_memory_cache) > GEOCODE_CACHE_MAXSIZE:
+            _geocode_memory_cache.popitem(last=False)
+
+def _store_cached_coordinates(cache_key: str, address_string: str, coordinates: dict) -> None:
+    """
+    Guarda coordenadas en la caché en memoria y en Firestore (si está inicializado).
+    """
+    _remember_coordinates(cache_key, coordinates)
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        return
+
+    try:
+        doc_id = hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
+        get_db().collection(GEOCODE_CACHE_COLLECTION).document(doc_id).set({
+            'address': address_string,
+            'normalized_address': cache_key,
+            'coordinates': coordinates,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        logger.warning(f"Error guardando la caché de geocodificación para '{cache_key}': {e}")
+
+def normalize_coordinates(coordinates: dict | None) -> dict | None:
+    """
+    Devuelve las coordenadas solo si tienen latitud y longitud; en otro caso None.
+    Permite reemplazar las comprobaciones campo por campo con un simple "is None".
+    """
+    if not coordinates or coordinates.get('latitude') is None or coordinates.get('longitude') is None:
+        return None
+    return coordinates
+
 def geocode_address(address_string: str) -> dict:
     """
-    Geocodifica una dirección usando Nominatim con un enfoque robusto.
-    Se utiliza un viewbox para Rosario para mejorar la precisión.
+    Geocodifica una dirección. Los resultados exitosos se guardan en caché (memoria y Firestore)
+    por dirección normalizada, de modo que las direcciones repetidas no vuelven a consultar Nominatim.
 
     :param address_string: Dirección a geocodificar
     :return: Diccionario con latitude y longitude
     """
-    geolocator = Nominatim(user_agent="granix-backend/1.0")
-    
-    # Coordenadas del viewbox para Rosario, Argentina: [(sur, oeste), (norte, este)]
-    # Esto ayuda a Nominatim a priorizar resultados dentro de esta área.
-    ROSARIO_VIEWBOX = [(-33.016, -60.75), (-32.85, -60.6)]
-
     # Usar la dirección por defecto si la dirección proporcionada es None o vacía
     if not address_string:
         logger.warning("Dirección vacía proporcionada para geocodificación. Usando dirección por defecto.")
         address_string = DEFAULT_START_ADDRESS
 
+    cache_key = _normalize_address_key(address_string)
+    cached_coordinates = _get_cached_coordinates(cache_key)
+    if cached_coordinates:
+        return dict(cached_coordinates)
+
+    # Si otro hilo ya está geocodificando la misma dirección, se espera su resultado
+    # en lugar de repetir la consulta a Nominatim. La caché en memoria se vuelve a mirar bajo el lock:
+    # el hilo que geocodifica la guarda antes de quitarse de _geocode_in_flight, así que una dirección
+    # recién resuelta está en uno de los dos sitios y no se consulta dos veces.
+    with _geocode_cache_lock:
+        cached_coordinates = _geocode_memory_cache.get(cache_key)
+        if cached_coordinates is not None:
+            _geocode_memory_cache.move_to_end(cache_key)
+            return dict(cached_coordinates)
+        pending = _geocode_in_flight.get(cache_key)
+        if pending is None:
+            pending = _geocode_in_flight[cache_key] = Future()
+            is_owner = True
+        else:
+            is_owner = False
+    if not is_owner:
+        return dict(pending.result())
+
+    try:
+        coordinates = _geocode_with_nominatim(address_string)
+        if normalize_coordinates(coordinates) is not None:
+            _store_cached_coordinates(cache_key, address_string, coordinates)
+        pending.set_result(coordinates)
+    except Exception as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        with _geocode_cache_lock:
+            del _geocode_in_flight[cache_key]
+    return coordinates
+
+def _geocode_with_nominatim(address_string: str) -> dict:
+    """
+    Geocodifica una dirección usando Nominatim con un enfoque robusto.
+    Se utiliza un viewbox para Rosario para mejorar la precisión.
+
+    :param address_string: Dirección a geocodificar
+    :return: Diccionario con latitude y longitude
+    """
     # --- Normalización de Direcciones ---
     # Reemplaza nombres de calles comunes o ambiguos por su versión completa para mejorar la precisión.
     normalized_address = address_string
     if re.search(r'^\s*Andrade\b', address_string, re.IGNORECASE):
         normalized_address = re.sub(r'Andrade', 'Olegario Victor Andrade', address_string, count=1, flags=re.IGNORECASE)
-        logger.info(f"Dirección normalizada: '{address_string}' -> '{normalized_address}'")
+        logger.debug("Dirección normalizada: '%s' -> '%s'", address_string, normalized_address)
 
     city = "Rosario"
     if "25 De Mayo" in normalized_address:
@@ -89,7 +297,7 @@ def geocode_address(address_string: str) -> dict:
     try:
         full_query = f"{normalized_address}, {city}, Santa Fe, Argentina"
         # Geocodificar con viewbox para Rosario y bounded=True para limitar los resultados a esa caja.
-        location = geolocator.geocode(
+        location = _nominatim_geocode(
             full_query, 
             country_codes='ar', 
             timeout=10, 
@@ -105,7 +313,7 @@ def geocode_address(address_string: str) -> dict:
         else:
             logger.warning(f"Nominatim no pudo geocodificar la dirección: {full_query}. Intentando sin viewbox.")
             # Si falla, intentar sin el viewbox como fallback
-            location = geolocator.geocode(full_query, country_codes='ar', timeout=10)
+            location = _nominatim_geocode(full_query, country_codes='ar', timeout=10)
             if location:
                 return {
                     "latitude": location.latitude,
@@ -119,9 +327,22 @@ def geocode_address(address_string: str) -> dict:
         return {"latitude": None, "longitude": None} # Fallback final
 
 @contextmanager
-def temp_file_path(suffix=""):
-    fd, path = tempfile.mkstemp(suffix=suffix)
-    os.close(fd) # Close the file descriptor immediately
+def uploaded_file_path(file_obj, suffix=""):
+    """
+    Copia un archivo subido (FileStorage) a un archivo temporal y devuelve su ruta; lo elimina al salir.
+    Escribe sobre el mismo descriptor que crea el archivo, con un buffer de 1 MiB.
+
+    :param file_obj: objeto FileStorage recibido en la petición
+    :param suffix: Sufijo del archivo temporal (por ejemplo, la extensión)
+    """
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        path = temp_file.name
+        try:
+            shutil.copyfileobj(file_obj.stream, temp_file, UPLOAD_COPY_BUFFER_SIZE)
+        except Exception:
+            temp_file.close()
+            os.unlink(path)
+            raise
     try:
         yield path
     finally:
@@ -137,7 +358,7 @@ def cleanup_temp_file(file_path: str) -> None:
     try:
         if os.path.exists(file_path):
             os.unlink(file_path)
-            logger.info(f"Archivo temporal eliminado: {file_path}")
+            logger.debug("Archivo temporal eliminado: %s", file_path)
     except Exception as e:
         logger.warning(f"Error eliminando archivo temporal {file_path}: {e}")
 
@@ -150,40 +371,98 @@ def _extract_text_from_pdf(pdf_path: str) -> str:
         logger.error("POPPLER_PATH no está configurado en las variables de entorno.")
         raise ValueError("La ruta a Poppler no está configurada.")
 
-    images = convert_from_path(pdf_path, poppler_path=poppler_path)
-    full_text = []
-    for i, image in enumerate(images):
-        # Save image to a BytesIO object instead of a temporary file
-        with io.BytesIO() as image_bytes_io:
-            image.save(image_bytes_io, format='PNG')
-            image_bytes_io.seek(0) # Rewind to the beginning of the stream
-            full_text.append(extract_text_from_image(image_bytes_io))
+    # Las páginas se escriben como archivos en un directorio temporal en lugar de mantenerse
+    # todas en memoria como imágenes PIL; el OCR las lee desde disco. Solo se usan para el OCR,
+    # así que se generan en escala de grises: un canal en lugar de tres para escribir y decodificar.
+    with tempfile.TemporaryDirectory() as pages_dir:
+        page_paths = convert_from_path(
+            pdf_path,
+            dpi=PDF_RENDER_DPI,
+            poppler_path=poppler_path,
+            output_folder=pages_dir,
+            paths_only=True,
+            fmt='jpeg',
+            grayscale=True,
+            use_pdftocairo=True,
+            thread_count=PDF_RENDER_THREADS
+        )
+        if not page_paths:
+            return ""
+
+        # Tesseract corre fuera del GIL: las páginas se procesan en paralelo y map conserva su orden.
+        with ThreadPoolExecutor(max_workers=min(OCR_WORKERS, len(page_paths))) as executor:
+            if PyTessBaseAPI is not None:
+                full_text = list(executor.map(extract_text_from_image, page_paths))
+            else:
+                full_text = _ocr_pages_with_list_files(executor, page_paths, pages_dir)
     return "\n".join(full_text)
 
-def upload_image_to_cloudinary(file_obj) -> str:
+def _ocr_pages_with_list_files(executor: ThreadPoolExecutor, page_paths: list, pages_dir: str) -> list:
+    """
+    OCR de las páginas con el binario de tesseract, repartidas en lotes: cada proceso carga los datos
+    del idioma una sola vez para todo su lote y los lotes corren en paralelo.
+
+    :return: Texto de cada página, en orden
     """
-    Sube un archivo de imagen a Cloudinary y retorna la URL segura.
+    lang = _tesseract_lang()
+
+    def binarize_page(page_path):
+        binarized_path = os.path.splitext(page_path)[0] + ".png"
+        _prepare_ocr_image(page_path).save(binarized_path)
+        return binarized_path
+
+    binarized_paths = list(executor.map(binarize_page, page_paths))
+
+    batch_size = min(TESSERACT_LIST_BATCH_SIZE, -(-len(binarized_paths) // OCR_WORKERS))
+    batches = [binarized_paths[i:i + batch_size] for i in range(0, len(binarized_paths), batch_size)]
+    list_paths = [os.path.join(pages_dir, f"pages_{i}.txt") for i in range(len(batches))]
+    results = executor.map(_ocr_image_list, batches, list_paths, [lang] * len(batches))
+    return [text for batch_texts in results for text in batch_texts]
+
+def upload_image_to_cloudinary(file_obj) -> tuple[str, str]:
+    """
+    Sube un archivo de imagen a Cloudinary y retorna la URL segura y el public_id.
 
     :param file_obj: objeto FileStorage o ruta a un archivo
-    :return: URL segura del archivo subido
+    :return: Tupla (URL segura, public_id) del archivo subido
     :raises: Exception en caso de error de subida
     """
+    for attempt in range(1, CLOUDINARY_UPLOAD_ATTEMPTS + 1):
+        try:
+            upload_result = cloudinary.uploader.upload(
+                file_obj,
+                folder="granix-invoices"
+            )
+            return upload_result['secure_url'], upload_result['public_id']
+        except Exception as e:
+            if isinstance(e, _CLOUDINARY_PERMANENT_ERRORS) or attempt == CLOUDINARY_UPLOAD_ATTEMPTS:
+                logger.error(f"Error al subir a Cloudinary: {e}")
+                raise
+            logger.warning(f"Error transitorio al subir a Cloudinary (intento {attempt}/{CLOUDINARY_UPLOAD_ATTEMPTS}): {e}")
+            # Un archivo abierto se rebobina para volver a enviarlo completo.
+            if hasattr(file_obj, 'seek'):
+                file_obj.seek(0)
+            time.sleep(CLOUDINARY_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+def delete_image_from_cloudinary(public_id: str) -> None:
+    """
+    Elimina una imagen de Cloudinary. Los errores se registran sin propagarse.
+
+    :param public_id: public_id devuelto por upload_image_to_cloudinary
+    """
     try:
-        upload_result = cloudinary.uploader.upload(
-            file_obj,
-            folder="granix-invoices"
-        )
-        return upload_result['secure_url']
+        cloudinary.uploader.destroy(public_id)
+        logger.debug("Imagen eliminada de Cloudinary: %s", public_id)
     except Exception as e:
-        logger.error(f"Error al subir a Cloudinary: {e}")
-        raise
+        logger.error(f"Error al eliminar la imagen {public_id} de Cloudinary: {e}")
 
-def save_invoice_data(invoice_id: str, data: dict) -> None:
+def save_invoice_data(invoice_id: str, data: dict, batch=None) -> None:
     """
     Guarda datos de factura en Firestore.
     
     :param invoice_id: ID del documento
     :param data: Datos a guardar
+    :param batch: WriteBatch opcional; si se indica, la escritura se agrega al lote y se guarda al confirmarlo
     :raises: ValueError si Firestore no está configurado
     """
     # Usar get_app() para verificar si Firebase está inicializado
@@ -192,21 +471,60 @@ def save_invoice_data(invoice_id: str, data: dict) -> None:
     except ValueError:
         raise ValueError("Firebase Admin no está inicializado.")
     
-    db = firestore.client()
+    db = get_db()
     doc_ref = db.collection('invoices').document(invoice_id)
+    if batch is not None:
+        batch.set(doc_ref, data)
+        return
     doc_ref.set(data)
-    logger.info(f"[Invoice:{invoice_id}] Datos guardados en Firestore para invoice_id: {invoice_id}")
+    logger.debug("[Invoice:%s] Datos guardados en Firestore para invoice_id: %s", invoice_id, invoice_id)
 
-def extract_text_from_image(image_input) -> str:
+@contextmanager
+def _tesseract_api(lang: str):
     """
-    Extrae texto usando Tesseract a través de pytesseract.
+    Toma prestada una instancia de tesserocr del pool del idioma y la devuelve al terminar.
+    Crea instancias hasta OCR_POOL_SIZE; con todas en uso, espera a que se libere una o a que falle
+    una creación, en cuyo caso el hilo que espera intenta crearla (y recibe el error si vuelve a fallar).
     """
+    with _tesseract_pools_lock:
+        pool = _tesseract_pools.get(lang)
+        if pool is None:
+            pool = _tesseract_pools[lang] = {
+                'idle': [], 'created': 0, 'available': threading.Condition(_tesseract_pools_lock)
+            }
+        while not pool['idle'] and pool['created'] >= OCR_POOL_SIZE:
+            pool['available'].wait()
+        if pool['idle']:
+            api = pool['idle'].pop()
+        else:
+            api = None
+            pool['created'] += 1
+
+    if api is None:
+        try:
+            api = PyTessBaseAPI(lang=lang, psm=TESSERACT_PSM, oem=TESSERACT_OEM)
+        except Exception:
+            with _tesseract_pools_lock:
+                pool['created'] -= 1
+                pool['available'].notify()
+            raise
+    try:
+        yield api
+    finally:
+        with _tesseract_pools_lock:
+            pool['idle'].append(api)
+            pool['available'].notify()
+
+def _tesseract_lang() -> str:
+    """Aplica TESSERACT_CMD (si está definido) y devuelve el idioma configurado para el OCR."""
     tesseract_cmd = os.getenv("TESSERACT_CMD")
     if tesseract_cmd:
+        import pytesseract
         pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    return os.getenv("TESSERACT_LANG", "spa+eng")
 
-    lang = os.getenv("TESSERACT_LANG", "spa+eng")
-
+def _prepare_ocr_image(image_input) -> Image.Image:
+    """Abre la imagen (ruta, bytes, archivo o PIL) y la binariza para el OCR."""
     img = None
     if isinstance(image_input, Image.Image):
         img = image_input
@@ -222,10 +540,47 @@ def extract_text_from_image(image_input) -> str:
 
     try:
         img = img.convert("L")
-        # Add binarization step
-        img = img.point(lambda x: 0 if x < 180 else 255, '1')
+        # Binarización con una tabla de 256 valores aplicada en C por Pillow, sin copias intermedias;
+        # Tesseract acepta la imagen en escala de grises 0/255.
+        img = img.point(_BINARIZE_LUT)
     except Exception:
         pass
+    return img
+
+def _ocr_image_list(image_paths: list, list_path: str, lang: str) -> list:
+    """
+    Aplica OCR a varias imágenes con un solo proceso de Tesseract, pasándole un archivo con sus rutas.
+
+    :param image_paths: Rutas de las imágenes, en orden
+    :param list_path: Ruta donde escribir el archivo con la lista de imágenes
+    :param lang: Idioma de Tesseract
+    :return: Texto de cada imagen (o el texto completo en un solo elemento si no se pudo separar por página)
+    """
+    import pytesseract
+
+    with open(list_path, "w", encoding="utf-8") as list_file:
+        list_file.write("\n".join(image_paths) + "\n")
+    output = pytesseract.image_to_string(list_path, lang=lang, config=TESSERACT_CONFIG)
+    # Tesseract termina cada página con un salto de página (\f), igual que al procesarlas de a una.
+    pages = output.split("\f")[:-1]
+    if len(pages) != len(image_paths):
+        return [output]
+    return [page + "\f" for page in pages]
+
+def extract_text_from_image(image_input) -> str:
+    """
+    Extrae texto usando Tesseract: con tesserocr si está instalado, o a través de pytesseract.
+    """
+    lang = _tesseract_lang()
+    img = _prepare_ocr_image(image_input)
+
+    if PyTessBaseAPI is not None:
+        # En proceso: sin lanzar el binario ni recargar los datos del idioma por cada imagen.
+        with _tesseract_api(lang) as api:
+            api.SetImage(img)
+            return api.GetUTF8Text()
 
-    text = pytesseract.image_to_string(img, lang=lang)
-    return text
\ No newline at end of file
+    # pytesseract se importa solo sin tesserocr (al importarse carga pandas si está instalado).
+    import pytesseract
+    text = pytesseract.image_to_string(img, lang=lang, config=TESSERACT_CONFIG)
+    return text
@@ -0,0 +1,92 @@
+import random
+import re
+
+from granix_backend.parsing.delivery_parser import DeliveryReportParser
+
+# Expresión regular de direcciones del parser original, usada como referencia de equivalencia
+# para la búsqueda por literales de _find_address_span.
+BASELINE_ADDRESS_PATTERN = re.compile(
+    r'(?:.*?)((?:Pasaje|Pje\.|Alvear|San Juan|Zeballos|Velez Sarsfield|Cordiviola|Drago|Del Valle|Andrade|Sanchez De Bustamante|Corrientes|Buenos Aires|Entre Rios|Marco Polo|Ibarlucea|Nansen|Reconquista|Av. Alberdi|Balcarce|3 De Febrero|Mendoza|Rodriguez|Santiago|San Luis|Ayacucho|San Martin|Laprida|Arijon|Regimiento|Artigas|Thedy|French|Juan Jose Paso|Genova|Jose Ingenieros)(?:[\s\w,.]*?)(?:N[°º.]?\s*)?\d+)(?:,\s*[A-ZÁÉÍÓÚÜÑ][a-záéíóúüñA-ZÁÉÍÓÚÜÑ\s]*)*,\s*Rosario',
+    re.IGNORECASE
+)
+
+REPORT_TEXT = """Informe de Reparto
+Fa P0298-00012345 KIOSCO EL SOL Alvear N° 1234, Rosario 3
+Re P0299 12345678 9 ALMACEN DON PEPE SRL San Juan 850, Barrio Centro, Rosario Entrega: dejar en
+Suc 2 la puerta trasera
+Fa P0298-00054321 DESPENSA LA ESQUINA Av, Alberdi 1500, Rosario 2
+Fa P0298-00054322 MERCADO NORTE av. alberdi 900, Rosario 1
+Fa P0298-00054323 SIN DIRECCION CONOCIDA 5
+Cantidad de Facturas: 3 Cantidad de Remitos: 1 Bultos: 20
+"""
+
+# Salida del parser original para REPORT_TEXT.
+EXPECTED_ITEMS = [
+    ('Fa', 'P0298-00012345', 'KIOSCO EL SOL', 'Alvear 1234', 3, 'No encontrado'),
+    ('Re', 'P0299123456789', 'ALMACEN DON PEPE SRL', 'San Juan 850', 0, 'dejar en la puerta trasera'),
+    ('Fa', 'P0298-00054321', 'DESPENSA LA ESQUINA', 'Av, Alberdi 1500', 2, 'No encontrado'),
+    ('Fa', 'P0298-00054322', 'MERCADO NORTE', 'Av. Alberdi 900', 1, 'No encontrado'),
+    ('Fa', 'P0298-00054323', 'SIN DIRECCION CONOCIDA', 'No encontrado', 5, 'No encontrado'),
+]
+
+WORDS = [
+    'KIOSCO', 'el', 'Sol', 'San', 'Juan', 'San Martin', 'Pje.', 'Pje', 'Alvear', 'N°', 'Nº', 'N.', '123', '45', '7',
+    ',', 'Rosario', ', Rosario', 'Barrio', 'de', '3 De Febrero', 'Drago', 'DRAGON', 'Nansen', 'Bar Nansen',
+    'Av. Alberdi', 'av, alberdi', 'mendoza', 'Rodriguez', 'Santiago', 'sanchez de bustamante', 'ESQ', 'Suc',
+]
+
+
+def _baseline_span(text):
+    match = BASELINE_ADDRESS_PATTERN.search(text)
+    return (match.start(1), match.end(1)) if match else None
+
+
+def test_parse_report_matches_baseline_output():
+    result = DeliveryReportParser().parse_delivery_report_text(REPORT_TEXT)
+
+    items = [
+        (item.type, item.invoice_number, item.commercial_entity, item.delivery_address, item.packages,
+         item.delivery_instructions)
+        for item in result['delivery_items']
+    ]
+    assert items == EXPECTED_ITEMS
+    assert (result['total_invoices'], result['total_remitos'], result['total_packages_summary']) == (3, 1, 20)
+
+
+def test_find_address_span_matches_baseline_regex():
+    parser = DeliveryReportParser()
+    rng = random.Random(0)
+    for _ in range(3000):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        assert parser._find_address_span(text) == _baseline_span(text), text
+
+
+def test_avenida_alberdi_ocr_variants():
+    parser = DeliveryReportParser()
+    for street in ('Av. Alberdi', 'Av, Alberdi', 'Av Alberdi', 'AV.ALBERDI', 'av,  alberdi'):
+        text = f"Fa P0298-00011111 DESPENSA LA ESQUINA {street} 1500, Rosario 2"
+        item = parser.parse_delivery_report_text(text)['delivery_items'][0]
+
+        assert item.delivery_address.lower().startswith('av') and item.delivery_address.endswith('Alberdi 1500'), street
+        assert item.commercial_entity == 'DESPENSA LA ESQUINA', street
+
+
+def test_delivery_item_to_dict_keeps_the_original_keys():
+    items = DeliveryReportParser().parse_delivery_report_text(REPORT_TEXT)['delivery_items']
+
+    assert items[0].to_dict() == {
+        'type': 'Fa',
+        'invoice_number': 'P0298-00012345',
+        'commercial_entity': 'KIOSCO EL SOL',
+        'delivery_address': 'Alvear 1234',
+        'packages': 3,
+        'delivery_instructions': 'No encontrado',
+        'address': 'Alvear 1234',
+    }
+    # Sin dirección no hay 'address', igual que en el diccionario original.
+    assert 'address' not in items[4].to_dict()
+
+    items[0].coordinates = {'latitude': None, 'longitude': None}
+    items[0].status = 'review_required'
+    assert items[0].to_dict()['coordinates'] == {'latitude': None, 'longitude': None}
+    assert 'error_notes' not in items[0].to_dict()
@@ -0,0 +1,66 @@
+import threading
+import time
+from unittest import mock
+
+from granix_backend.utils import shared_utils
+
+
+def _counting_geocoder(calls, coordinates, delay=0.05):
+    def geocode(address_string):
+        calls.append(address_string)
+        time.sleep(delay)
+        return dict(coordinates)
+    return geocode
+
+
+def _run_in_threads(target, count):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_geocodes_of_one_address_query_nominatim_once():
+    calls = []
+    coordinates = {'latitude': -32.95, 'longitude': -60.65}
+    with mock.patch.object(shared_utils, '_geocode_with_nominatim', _counting_geocoder(calls, coordinates)):
+        results = _run_in_threads(lambda: shared_utils.geocode_address('Alvear 1234 (prueba concurrente)'), 8)
+
+    assert len(calls) == 1
+    assert results == [coordinates] * 8
+
+
+def test_geocode_rechecks_the_cache_before_querying_again():
+    # El segundo hilo no encuentra la dirección en la primera consulta a la caché y llega al registro de
+    # geocodificaciones en curso cuando el primero ya terminó: debe usar la caché y no volver a consultar.
+    calls = []
+    coordinates = {'latitude': -32.9, 'longitude': -60.7}
+    address = 'San Juan 850 (prueba de carrera)'
+    with mock.patch.object(shared_utils, '_geocode_with_nominatim', _counting_geocoder(calls, coordinates)):
+        owner = threading.Thread(target=shared_utils.geocode_address, args=(address,))
+        owner.start()
+        time.sleep(0.01)
+
+        def stale_cache_miss(cache_key):
+            time.sleep(0.1)
+            return None
+
+        with mock.patch.object(shared_utils, '_get_cached_coordinates', stale_cache_miss):
+            result = shared_utils.geocode_address(address)
+        owner.join()
+
+    assert len(calls) == 1
+    assert result == coordinates
+
+
+def test_failed_geocode_is_not_cached():
+    calls = []
+    failed = {'latitude': None, 'longitude': None}
+    with mock.patch.object(shared_utils, '_geocode_with_nominatim', _counting_geocoder(calls, failed, delay=0)):
+        assert shared_utils.geocode_address('Calle Inexistente 1 (prueba)') == failed
+        assert shared_utils.geocode_address('Calle Inexistente 1 (prueba)') == failed
+
+    assert len(calls) == 2
@@ -0,0 +1,113 @@
+import itertools
+import random
+from math import radians, sin, cos, sqrt, atan2
+
+import numpy as np
+
+from granix_backend.optimization.route_optimizer import _build_distance_matrix, _decode_polyline, _solve_tsp_exact
+
+
+def haversine_distance(coord1, coord2):
+    """Implementación original, punto a punto, de la distancia haversine (en metros, entera)."""
+    R = 6371000
+    lat1, lon1 = radians(coord1[0]), radians(coord1[1])
+    lat2, lon2 = radians(coord2[0]), radians(coord2[1])
+    a = sin((lat2 - lat1) / 2)**2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2)**2
+    return int(R * 2 * atan2(sqrt(a), sqrt(1 - a)))
+
+
+def decode_polyline(encoded):
+    """Decodificador de referencia de polilíneas (precisión 5), carácter por carácter."""
+    coordinates = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                chunk = ord(encoded[index]) - 63
+                index += 1
+                result |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coordinates.append((lat / 1e5, lon / 1e5))
+    return coordinates
+
+
+def encode_polyline(coordinates):
+    """Codifica coordenadas (lat, lon) como polilínea de precisión 5."""
+    encoded = []
+    previous = (0, 0)
+    for lat, lon in coordinates:
+        current = (round(lat * 1e5), round(lon * 1e5))
+        for delta in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous = current
+    return ''.join(encoded)
+
+
+def brute_force_tsp(distance_matrix):
+    """Recorrido óptimo por fuerza bruta, saliendo y volviendo al nodo 0."""
+    n = len(distance_matrix)
+    return min(
+        distance_matrix[0][order[0]] + sum(distance_matrix[a][b] for a, b in zip(order, order[1:])) + distance_matrix[order[-1]][0]
+        for order in itertools.permutations(range(1, n))
+    )
+
+
+def test_build_distance_matrix_matches_pointwise_haversine():
+    rng = random.Random(0)
+    points = [(rng.uniform(-33.02, -32.85), rng.uniform(-60.75, -60.6)) for _ in range(25)]
+
+    matrix = _build_distance_matrix(points)
+
+    expected = np.array([[haversine_distance(p, q) for q in points] for p in points])
+    # arcsin y atan2 pueden diferir en el último bit y cambiar el truncado a entero en un metro.
+    assert np.abs(matrix - expected).max() <= 1
+    assert (np.diag(matrix) == 0).all()
+
+
+def test_decode_polyline_reference_example():
+    decoded = _decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    assert decoded.tolist() == [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+
+
+def test_decode_polyline_matches_reference_decoder():
+    rng = random.Random(0)
+    for _ in range(200):
+        coordinates = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(rng.randint(1, 50))]
+        encoded = encode_polyline(coordinates)
+
+        assert _decode_polyline(encoded).tolist() == [list(point) for point in decode_polyline(encoded)]
+    assert _decode_polyline('').shape == (0, 2)
+
+
+def test_solve_tsp_exact_matches_brute_force():
+    rng = random.Random(0)
+    for n in range(1, 9):
+        for _ in range(5):
+            points = [(rng.uniform(-33.02, -32.85), rng.uniform(-60.75, -60.6)) for _ in range(n)]
+            distance_matrix = _build_distance_matrix(points)
+            # También matrices asimétricas, como las de OSRM (sentidos de circulación).
+            if n > 2 and rng.random() < 0.5:
+                distance_matrix = distance_matrix + np.array([[rng.randint(0, 500) for _ in range(n)] for _ in range(n)])
+                np.fill_diagonal(distance_matrix, 0)
+
+            order, total_distance = _solve_tsp_exact(distance_matrix)
+
+            if n == 1:
+                assert (order, total_distance) == ([], 0)
+                continue
+            assert sorted(order) == list(range(1, n))
+            route = [0] + order + [0]
+            assert total_distance == sum(int(distance_matrix[a, b]) for a, b in zip(route, route[1:]))
+            assert total_distance == brute_force_tsp(distance_matrix.tolist())